@@ -0,0 +1,81 @@
+"""Generated benchmark data: html pages, token histograms (like the crawler makes) and queries.
+Everything comes from a seeded random generator, so the same seed always gives the same data
+"""
+from collections import Counter
+import itertools
+import random
+
+LETTERS = "etaoinshrdlcumwfgypbvkjxqz"
+# letter frequencies, roughly like english
+LETTER_WEIGHTS = [12.7, 9.1, 8.2, 7.5, 7.0, 6.7, 6.3, 6.1, 6.0, 4.3, 4.0, 2.8, 2.8, 2.4, 2.4, 2.2, 2.0, 2.0, 1.9, 1.5, 1.0, 0.8, 0.2, 0.2, 0.1, 0.1]
+SUFFIXES = ["", "", "", "s", "ing", "ed", "ly", "ness", "er", "ation"]
+
+
+class Vocabulary:
+    """Made up words with Zipf distributed frequencies, so a few words are very common and most are rare"""
+
+    def __init__(self, size=20000, seed=0) -> None:
+        rng = random.Random(seed)
+        words = set()
+        while len(words) < size:
+            length = rng.randint(2, 9)
+            words.add("".join(rng.choices(LETTERS, LETTER_WEIGHTS, k=length)) + rng.choice(SUFFIXES))
+        self.words = sorted(words)
+        rng.shuffle(self.words)
+        self.cum_weights = list(itertools.accumulate(1 / rank for rank in range(1, size + 1)))
+
+    def sample(self, rng: random.Random, k: int) -> list:
+        return rng.choices(self.words, cum_weights=self.cum_weights, k=k)
+
+    def text(self, rng: random.Random, words: int) -> str:
+        return " ".join(self.sample(rng, words))
+
+
+def make_page(vocab: Vocabulary, rng: random.Random, i: int) -> str:
+    """Returns html of a page with a head, nested sections of text, images, links, scripts and styles"""
+    parts = [
+        "<html><head>",
+        f"<title>{vocab.text(rng, rng.randint(3, 10)).title()}</title>",
+        f'<meta name="description" content="{vocab.text(rng, rng.randint(10, 60))}">',
+        "<style>body { margin: 0 } .nav a { color: blue }</style>",
+        "<script>window.analytics = {page: %d};</script>" % i,
+        '</head><body><div class="nav">',
+    ]
+    parts += [f'<a href="/page/{rng.randint(0, 100000)}">{vocab.text(rng, 2)}</a>' for _ in range(rng.randint(5, 20))]
+    parts.append("</div>")
+    for section in range(rng.randint(2, 8)):
+        parts.append(f"<div class=\"section\"><h2>{vocab.text(rng, rng.randint(2, 6))}</h2>")
+        for paragraph in range(rng.randint(1, 6)):
+            parts.append(f"<p>{vocab.text(rng, rng.randint(20, 120))} <a href=\"https://example{rng.randint(0, 500)}.com/{i}\">{vocab.text(rng, 3)}</a></p>")
+            if rng.random() < 0.3:
+                parts.append(f'<div class="figure"><img src="/img/{i}-{section}-{paragraph}.png" alt="{vocab.text(rng, rng.randint(0, 6))}"><span>{vocab.text(rng, rng.randint(0, 15))}</span></div>')
+        parts.append("</div>")
+    parts.append(f"<footer>{vocab.text(rng, 15)}</footer></body></html>")
+    return "\n".join(parts)
+
+
+def make_pages(count=500, seed=0, vocab=None) -> list:
+    vocab = vocab or Vocabulary(seed=seed)
+    rng = random.Random(seed)
+    return [make_page(vocab, rng, i) for i in range(count)]
+
+
+def make_histograms(count=10000, seed=0, vocab=None, min_words=50, max_words=1500) -> list:
+    """Returns token histograms of made up pages, like {"url": url, "tokens": {token: count}}"""
+    vocab = vocab or Vocabulary(seed=seed)
+    rng = random.Random(seed + 1)
+    return [
+        {"url": f"https://bench{i % 997}.example.com/page/{i}", "tokens": dict(Counter(vocab.sample(rng, rng.randint(min_words, max_words))))}
+        for i in range(count)
+    ]
+
+
+def make_queries(histograms: list, count=200, seed=0) -> list:
+    """Returns queries of 1 to 4 tokens, picked like people search: mostly words that are on some pages, some common ones"""
+    rng = random.Random(seed + 2)
+    queries = []
+    for _ in range(count):
+        page = rng.choice(histograms)
+        tokens = list(page["tokens"])
+        queries.append(rng.sample(tokens, min(len(tokens), rng.randint(1, 4))))
+    return queries
@@ -0,0 +1,152 @@
+"""Load generator for the search server: replays a query log against /search and reports latency percentiles,
+throughput and errors. Useful to size server workers, and to check ranking or caching changes under load.
+
+The query log is JSONL, one search per line: {"query": "...", "page": 2, "per_page": 10} (page and per_page are
+optional, a line can also be just a JSON string). Use --field to read queries from another field.
+
+Requests are sent at --rate per sec (open loop: a slow server doesn't slow down the requests) by --concurrency
+workers, or as fast as the workers can go if there's no rate. With a rate, latency is counted from when a request
+was due to be sent, so time spent waiting for a free worker counts too.
+- --warm sends every distinct query once before measuring, so measured searches come from the results cache
+- --cold sends "Cache-Control: no-cache", so the server ranks every query again
+
+Usage (from the project root, with the search server running):
+    python -m benchmarks.loadgen queries.jsonl --url http://127.0.0.1:5000 --concurrency 16 --rate 200 --cold
+"""
+from concurrent.futures import ThreadPoolExecutor
+from urllib.error import HTTPError
+from urllib.parse import urlencode
+from urllib.request import Request, urlopen
+import argparse
+import itertools
+import json
+import math
+import threading
+import time
+
+
+def read_log(path, field="query") -> list:
+    """Returns list of searches (dicts of /search params) in the query log"""
+    searches = []
+    with open(path) as f:
+        for line in f:
+            if not line.strip(): continue
+            entry = json.loads(line)
+            if isinstance(entry, str): entry = {field: entry}
+            if not entry.get(field, None): continue
+            search = {"query": entry[field]}
+            for param in ["page", "per_page"]:
+                if param in entry: search[param] = entry[param]
+            searches.append(search)
+    return searches
+
+
+def percentile(values: list, p: float) -> float:
+    """p-th percentile (nearest rank) of sorted values"""
+    if len(values) == 0: return 0
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+class LoadGenerator:
+    def __init__(self, url, concurrency=8, rate=0, timeout=10, cold=False) -> None:
+        self.url = url.rstrip("/") + "/search"
+        self.concurrency = concurrency
+        self.rate = rate
+        self.timeout = timeout
+        self.headers = {"Cache-Control": "no-cache"} if cold else {}
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.statuses = {}
+        self.errors = {}
+
+    def send(self, search) -> int:
+        """Sends a search, returns the status code (or raises if it didn't get a response)"""
+        request = Request(self.url + "?" + urlencode(search), headers=self.headers)
+        try:
+            with urlopen(request, timeout=self.timeout) as response:
+                response.read()
+                return response.status
+        except HTTPError as e: return e.code
+
+    def fetch(self, search, due=None):
+        # without a rate, requests are only due when a worker is free
+        if due is None: due = time.perf_counter()
+        try: status = self.send(search)
+        except Exception as e:
+            with self.lock:
+                self.errors[type(e).__name__] = self.errors.get(type(e).__name__, 0) + 1
+            return
+        latency = time.perf_counter() - due
+        with self.lock:
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+            if status == 200: self.latencies.append(latency)
+
+    def warm(self, searches):
+        """Sends every distinct search once, so they're in the results cache"""
+        distinct = list({json.dumps(search, sort_keys=True): search for search in searches}.values())
+        with ThreadPoolExecutor(self.concurrency) as pool:
+            list(pool.map(lambda search: self.send(search), distinct))
+        print ("- Warmed cache with", len(distinct), "searches")
+
+    def run(self, searches, total) -> dict:
+        """Sends `total` searches (going around the log again if it's shorter), returns the report"""
+        start = time.perf_counter()
+        with ThreadPoolExecutor(self.concurrency) as pool:
+            for i, search in enumerate(itertools.islice(itertools.cycle(searches), total)):
+                if self.rate > 0:
+                    due = start + i / self.rate
+                    if (wait := due - time.perf_counter()) > 0: time.sleep(wait)
+                else: due = None
+                pool.submit(self.fetch, search, due)
+        return self.report(time.perf_counter() - start)
+
+    def report(self, elapsed) -> dict:
+        latencies = sorted(self.latencies)
+        sent = sum(self.statuses.values()) + sum(self.errors.values())
+        failed = sent - len(latencies)
+        return {
+            "requests": sent,
+            "seconds": elapsed,
+            "throughput": len(latencies) / elapsed if elapsed > 0 else 0,
+            "error_rate": failed / sent if sent > 0 else 0,
+            "statuses": {str(status): count for status, count in sorted(self.statuses.items())},
+            "errors": self.errors,
+            "latency_ms": {
+                "mean": sum(latencies) / len(latencies) * 1000 if len(latencies) > 0 else 0,
+                "p50": percentile(latencies, 50) * 1000,
+                "p95": percentile(latencies, 95) * 1000,
+                "p99": percentile(latencies, 99) * 1000,
+                "max": latencies[-1] * 1000 if len(latencies) > 0 else 0
+            }
+        }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay a query log against the search server")
+    parser.add_argument("log", help="query log (JSONL)")
+    parser.add_argument("--url", default="http://127.0.0.1:5000", help="search server url")
+    parser.add_argument("--field", default="query", help="field of each log line with the query")
+    parser.add_argument("--concurrency", type=int, default=8, help="requests in flight at most")
+    parser.add_argument("--rate", type=float, default=0, help="requests per sec. 0 to send as fast as possible")
+    parser.add_argument("--requests", type=int, default=0, help="how many requests to send (default one per log line)")
+    parser.add_argument("--timeout", type=float, default=10, help="secs to wait for a response")
+    cache = parser.add_mutually_exclusive_group()
+    cache.add_argument("--warm", action="store_true", help="run every query once before measuring")
+    cache.add_argument("--cold", action="store_true", help="ask the server not to use cached results")
+    parser.add_argument("--output", help="also write the report to this file (JSON)")
+    args = parser.parse_args()
+
+    searches = read_log(args.log, args.field)
+    if len(searches) == 0: raise SystemExit(f"No queries in {args.log}")
+    generator = LoadGenerator(args.url, args.concurrency, args.rate, args.timeout, args.cold)
+    if args.warm: generator.warm(searches)
+    report = generator.run(searches, args.requests or len(searches))
+    report["params"] = {key: value for key, value in vars(args).items() if key != "output"}
+
+    latency = report["latency_ms"]
+    print (f"- {report['requests']} requests in {report['seconds']:.1f} secs, {report['throughput']:.1f} ok/sec")
+    print (f"- latency (ms): p50 {latency['p50']:.1f}, p95 {latency['p95']:.1f}, p99 {latency['p99']:.1f}, max {latency['max']:.1f}")
+    print (f"- error rate: {report['error_rate'] * 100:.2f}%, statuses: {report['statuses']}, errors: {report['errors']}")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=4)
@@ -0,0 +1,362 @@
+"""Benchmarks of the hot paths of crawling and searching, each timed on its own:
+
+- tokenize:         analyzer.get_words on page text
+- parse_document:   lxml parsing of page html
+- parse_html:       parsing a page into title, description, tokens and images (what parser workers do)
+- parser_pipeline:  ParserPipeline.process_item, as run in the crawler process
+- push_to_db:       PageTokensDatabase.insert_many + push_to_db of token histograms (building the bucket updates, and the write)
+- top_k_memory:     search.top_k over an in-memory index (just the scoring)
+- top_k_segment:    search.top_k over an IndexSegment
+- search_route:     the Flask /search route (app.results), with the results cache off
+
+The data is generated from a seed (see corpus.py), so runs are comparable. By default Mongo is replaced with an
+in-process fake that only records writes (so push_to_db times everything but the round trip). With --mongo,
+the Mongo backed benchmarks run against a scratch database on that server instead (it's dropped afterwards).
+
+Run from the project root:
+    python -m benchmarks.run [--mongo mongodb://127.0.0.1:27017] [--only tokenize parse_html] [--output results.json]
+    python -m benchmarks.run --compare results.json   (compare with an earlier run)
+"""
+from contextlib import redirect_stdout
+from benchmarks import corpus
+import argparse
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WEB_DIR = os.path.join(ROOT_DIR, "web")
+# the web server imports its modules from the web directory
+sys.path.insert(0, WEB_DIR)
+
+BENCHMARK_DB = "vsearch_benchmark"
+
+
+class FakeCollection:
+    """Stands in for a pymongo collection. Writes are counted and thrown away, reads come from `docs`"""
+    def __init__(self, docs=[]) -> None:
+        self.docs = {doc["_id"]: doc for doc in docs}
+        self.writes = 0
+
+    def insert_many(self, docs, ordered=True):
+        self.writes += len(docs)
+
+    def bulk_write(self, requests, ordered=True):
+        self.writes += len(requests)
+
+    def update_one(self, filter, update, upsert=False):
+        self.writes += 1
+
+    def find_one(self, filter={}):
+        return None
+
+    def estimated_document_count(self):
+        return len(self.docs)
+
+
+class FakeDatabase(dict):
+    def __missing__(self, name):
+        collection = self[name] = FakeCollection()
+        return collection
+
+
+class FakePagesDatabase:
+    """The reads the search route does on the pages collection, from a dict"""
+    def __init__(self, pages) -> None:
+        self.pages = {page["_id"]: page for page in pages}
+
+    def query(self, query={}, projection={}, skip=0, limit=0, sort=None) -> list:
+        return [{"_id": url, "rank": self.pages[url]["rank"]} for url in query["_id"]["$in"] if url in self.pages]
+
+    def get_results(self, urls: list, snippet_length=200) -> dict:
+        return {url: {
+            "url": url, "title": self.pages[url]["title"], "rank": self.pages[url]["rank"], "description": self.pages[url]["snippet"]
+        } for url in urls if url in self.pages}
+
+    def get_estimated_count(self) -> int:
+        return len(self.pages)
+
+    def get_generation(self) -> int:
+        return 0
+
+
+class MemoryIndex:
+    """Token postings in dicts, with the same search functions as PageTokensDatabase"""
+    def __init__(self, histograms) -> None:
+        self.postings = {}
+        for histogram in histograms:
+            for token, count in histogram["tokens"].items():
+                self.postings.setdefault(token, {})[histogram["url"]] = count
+        # postings of each token sorted by count, made when first asked for (like count-sorted buckets)
+        self.by_count = {}
+
+    def get_token_stats(self, tokens: list) -> dict:
+        return {token: {
+            "df": len(self.postings[token]), "max_count": max(self.postings[token].values())
+        } for token in tokens if token in self.postings}
+
+    def get_token_postings(self, token: str, min_count=0, urls=[]) -> dict:
+        urls = set(urls)
+        return {url: count for url, count in self.postings.get(token, {}).items() if count >= min_count or url in urls}
+
+    def get_top_postings(self, token: str, k=50) -> tuple:
+        from database import TopPostings
+        if (by_count := self.by_count.get(token, None)) is None:
+            by_count = self.by_count[token] = sorted(self.postings.get(token, {}).items(), key=lambda posting: posting[1], reverse=True)
+        top = TopPostings(k)
+        for url, count in by_count:
+            if top.done(count): break
+            top.add(url, count)
+        return top.postings, top.bound
+
+
+def make_page_docs(histograms, vocab, seed=0) -> list:
+    """Pages collection docs for the urls of the histograms"""
+    import random
+    rng = random.Random(seed + 3)
+    return [{
+        "_id": histogram["url"],
+        "url": histogram["url"],
+        "title": vocab.text(rng, 6).title(),
+        "description": vocab.text(rng, 50),
+        "snippet": vocab.text(rng, 30)[:200],
+        "rank": rng.random()
+    } for histogram in histograms]
+
+
+class Suite:
+    """Makes the data once, and runs benchmarks on it"""
+    def __init__(self, args) -> None:
+        self.args = args
+        self.mongo = args.mongo
+        self.vocab = corpus.Vocabulary(args.vocabulary, args.seed)
+        self.pages = corpus.make_pages(args.pages, args.seed, self.vocab)
+        self.histograms = corpus.make_histograms(args.histograms, args.seed, self.vocab)
+        self.queries = corpus.make_queries(self.histograms, args.queries, args.seed)
+        self.page_docs = make_page_docs(self.histograms, self.vocab, args.seed)
+        self.temp_dir = tempfile.mkdtemp(prefix="vsearch-benchmark-")
+        if self.mongo:
+            # database.py reads its settings from the environment when a database is made
+            os.environ["MONGODB_URL"] = self.mongo
+            os.environ["MONGODB_NAME"] = BENCHMARK_DB
+            for name in ["MONGODB_USER", "MONGODB_PWD", "MONGODB_AUTH_SRC", "MONGODB_AUTH_MECH"]:
+                os.environ.pop(name, None)
+
+    def benchmarks(self) -> dict:
+        """name -> (setup, run, items per run). setup's return value is passed to run, and isn't timed"""
+        return {
+            "tokenize": (self.page_texts, self.tokenize, len(self.pages)),
+            "parse_document": (None, self.parse_document, len(self.pages)),
+            "parse_html": (None, self.parse_html, len(self.pages)),
+            "parser_pipeline": (self.parse_trees, self.parser_pipeline, len(self.pages)),
+            "push_to_db": (self.tokens_db, self.push_to_db, len(self.histograms)),
+            "top_k_memory": (self.memory_index, self.top_k, len(self.queries)),
+            "top_k_segment": (self.segment_index, self.top_k, len(self.queries)),
+            "search_route": (self.search_app, self.search_route, len(self.queries)),
+        }
+
+    def measure(self, name, setup, run, items) -> dict:
+        times = []
+        # first run is a warm up (imports, caches, lazy connections), and isn't counted
+        for i in range(self.args.repeat + 1):
+            state = setup() if setup is not None else None
+            start = time.perf_counter()
+            run(state)
+            if i > 0: times.append(time.perf_counter() - start)
+        median = statistics.median(times)
+        return {
+            "runs": len(times),
+            "items": items,
+            "min_seconds": min(times),
+            "median_seconds": median,
+            "mean_seconds": statistics.mean(times),
+            "stdev_seconds": statistics.stdev(times) if len(times) > 1 else 0,
+            "items_per_sec": items / median if median > 0 else 0,
+            "backend": "mongo" if self.mongo and name in ("push_to_db", "search_route") else "memory"
+        }
+
+    def run(self, only=None) -> dict:
+        results = {}
+        try:
+            for name, (setup, run, items) in self.benchmarks().items():
+                if only and name not in only: continue
+                print (f"- {name}...", end=" ", flush=True)
+                results[name] = self.measure(name, setup, run, items)
+                print (f"{results[name]['median_seconds'] * 1000:.1f} ms ({results[name]['items_per_sec']:.1f}/sec)")
+        finally: self.clean_up()
+        return results
+
+    # parsing
+    def page_texts(self):
+        from lxml import html
+        if not hasattr(self, "texts"):
+            self.texts = [html.fromstring(page).text_content() for page in self.pages]
+        return self.texts
+
+    def tokenize(self, texts):
+        from analyzer import get_words
+        for text in texts: get_words(text)
+
+    def parse_document(self, state):
+        from webscraper.parser import parse_document
+        for page in self.pages: parse_document(page)
+
+    def parse_html(self, state):
+        from webscraper.parser import parse_html
+        for page in self.pages: parse_html(page)
+
+    def parse_trees(self):
+        # parse_tree changes the tree, so every run gets new ones
+        from webscraper.parser import parse_document
+        return [parse_document(page) for page in self.pages]
+
+    def parser_pipeline(self, docs):
+        # the pipelines module connects the crawler's databases on import
+        with redirect_stdout(io.StringIO()):
+            from webscraper.pipelines import ParserPipeline
+        pipeline = ParserPipeline()
+        pipeline.pool = None
+        for i, doc in enumerate(docs):
+            pipeline.process_item({"url": f"https://bench.example.com/{i}", "urls": [], "backlinks": [], "doc": doc}, None)
+
+    # index writes
+    def tokens_db(self):
+        from database import PageTokensDatabase
+        with redirect_stdout(io.StringIO()):
+            # buffer big enough to hold everything, so push_to_db is only called by us
+            db = PageTokensDatabase(sys.maxsize, 0, self.args.bucket_size)
+        if self.mongo:
+            db.collection.drop()
+            PageTokensDatabase.create_indexes(db.collection)
+        else:
+            db.database = FakeDatabase()
+            db.collection = db.database[db.collection.name]
+        return db
+
+    def push_to_db(self, db):
+        db.insert_many(self.histograms)
+        db.push_to_db()
+        if db.write_errors > 0: raise RuntimeError(f"{db.write_errors} failed writes")
+        with redirect_stdout(io.StringIO()): db.close_connection()
+
+    # search
+    def memory_index(self):
+        if not hasattr(self, "index"): self.index = MemoryIndex(self.histograms)
+        return self.index
+
+    def segment_index(self):
+        from segment import SegmentWriter, IndexSegment
+        if not hasattr(self, "segment"):
+            path = os.path.join(self.temp_dir, "index.seg")
+            writer = SegmentWriter(path, [histogram["url"] for histogram in self.histograms])
+            for token, postings in self.memory_index().postings.items():
+                writer.add_term(token, postings)
+            writer.close()
+            self.segment = IndexSegment(path)
+        return self.segment
+
+    def top_k(self, index):
+        from search import top_k
+        for query in self.queries: top_k(index, query, 100, len(self.histograms))
+
+    def search_app(self):
+        """The Flask app, searching the benchmark data (fake or in the scratch database)"""
+        if hasattr(self, "app"): return self.app
+        with redirect_stdout(io.StringIO()):
+            import app as search_app
+            from cache import ResultsCache, Generation
+        # every search gets ranked
+        search_app.results_cache = ResultsCache(0, 0)
+        if self.mongo:
+            from database import PageTokensDatabase
+            tokens_db = search_app.page_tokens_db
+            tokens_db.collection.drop()
+            PageTokensDatabase.create_indexes(tokens_db.collection)
+            for token, postings in self.memory_index().postings.items():
+                tokens_db.collection.insert_many(PageTokensDatabase.make_buckets(
+                    token, [{"url": url, "count": count} for url, count in postings.items()], self.args.bucket_size
+                ))
+            search_app.pages_db.collection.drop()
+            search_app.pages_db.collection.insert_many(self.page_docs)
+        else:
+            search_app.pages_db = FakePagesDatabase(self.page_docs)
+            search_app.get_total_docs = search_app.pages_db.get_estimated_count
+            search_app.generation = Generation(search_app.pages_db.get_generation, 60)
+            search_app.search_index = self.memory_index()
+        self.app = search_app
+        return search_app
+
+    def search_route(self, search_app):
+        client = search_app.app.test_client()
+        with redirect_stdout(io.StringIO()):
+            for query in self.queries:
+                response = client.get("/search", query_string={"query": " ".join(query)})
+                if response.status_code != 200: raise RuntimeError(f"/search returned {response.status_code}")
+
+    def clean_up(self):
+        if hasattr(self, "segment"): self.segment.close()
+        for name in os.listdir(self.temp_dir):
+            os.remove(os.path.join(self.temp_dir, name))
+        os.rmdir(self.temp_dir)
+        if self.mongo:
+            from pymongo import MongoClient
+            client = MongoClient(self.mongo)
+            client.drop_database(BENCHMARK_DB)
+            client.close()
+
+
+def git_info() -> dict:
+    def git(*args):
+        try: return subprocess.run(["git", *args], cwd=ROOT_DIR, capture_output=True, text=True, timeout=30).stdout.strip()
+        except Exception: return ""
+    return {"commit": git("rev-parse", "HEAD"), "dirty": git("status", "--porcelain", "--untracked-files=no") != ""}
+
+
+def compare(results: dict, old: dict):
+    """Prints median time of each benchmark against an earlier run (ratio < 1 means faster now)"""
+    print (f"\n- Compared to {old['meta'].get('commit', '?')[:10]}:")
+    for name, result in results.items():
+        if (old_result := old["results"].get(name, None)) is None: continue
+        ratio = result["median_seconds"] / old_result["median_seconds"]
+        print (f"  {name:<16} {old_result['median_seconds'] * 1000:10.1f} ms -> {result['median_seconds'] * 1000:10.1f} ms  ({ratio:.2f}x)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark parsing, tokenizing, index writes and search")
+    parser.add_argument("--only", nargs="+", help="benchmarks to run (default all)")
+    parser.add_argument("--mongo", help="run Mongo backed benchmarks against this server instead of a fake (uses a scratch database)")
+    parser.add_argument("--repeat", type=int, default=5, help="timed runs of each benchmark")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--pages", type=int, default=300, help="html pages to parse")
+    parser.add_argument("--histograms", type=int, default=5000, help="token histograms to index and search")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--vocabulary", type=int, default=20000, help="distinct words in the generated text")
+    parser.add_argument("--bucket-size", type=int, default=1000, help="max urls in a token bucket")
+    parser.add_argument("--output", help="write results to this file (JSON)")
+    parser.add_argument("--compare", help="results file (JSON) of an earlier run to compare with")
+    args = parser.parse_args()
+
+    results = Suite(args).run(args.only)
+    output = {
+        "meta": {
+            **git_info(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "params": {key: value for key, value in vars(args).items() if key not in ("output", "compare", "only")},
+        },
+        "results": results
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(output, f, indent=4)
+        print ("- Saved results to", args.output)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
@@ -0,0 +1,41 @@
+"""Text analysis shared by the crawler (when indexing) and the search server (when querying), so both make the same tokens"""
+from collections import Counter
+from functools import lru_cache
+from nltk import PorterStemmer
+import re
+
+# from nltk.corpus import stopwords
+# stopwords.words("english")
+STOP_WORDS = frozenset(['', 'i', 'me', 'my', 'myself', 'we', 'our', 'ours', 'ourselves', 'you', "you're", "you've", "you'll", "you'd", 'your', 'yours', 'yourself', 'yourselves', 'he', 'him', 'his', 'himself', 'she', "she's", 'her', 'hers', 'herself', 'it', "it's", 'its', 'itself', 'they', 'them', 'their', 'theirs', 'themselves', 'what', 'which', 'who', 'whom', 'this', 'that', "that'll", 'these', 'those', 'am', 'is', 'are', 'was', 'were', 'be', 'been', 'being', 'have', 'has', 'had', 'having', 'do', 'does', 'did', 'doing', 'a', 'an', 'the', 'and', 'but', 'if', 'or', 'because', 'as', 'until', 'while', 'of', 'at', 'by', 'for', 'with', 'about', 'against', 'between', 'into', 'through', 'during', 'before', 'after', 'above', 'below', 'to', 'from', 'up', 'down', 'in', 'out', 'on', 'off', 'over', 'under', 'again', 'further', 'then', 'once', 'here', 'there', 'when', 'where', 'why', 'how', 'all', 'any', 'both', 'each', 'few', 'more', 'most', 'other', 'some', 'such', 'no', 'nor', 'not', 'only', 'own', 'same', 'so', 'than', 'too', 'very', 's', 't', 'can', 'will', 'just', 'don', "don't", 'should', "should've", 'now', 'd', 'll', 'm', 'o', 're', 've', 'y', 'ain', 'aren', "aren't", 'couldn', "couldn't", 'didn', "didn't", 'doesn', "doesn't", 'hadn', "hadn't", 'hasn', "hasn't", 'haven', "haven't", 'isn', "isn't", 'ma', 'mightn', "mightn't", 'mustn', "mustn't", 'needn', "needn't", 'shan', "shan't", 'shouldn', "shouldn't", 'wasn', "wasn't", 'weren', "weren't", 'won', "won't", 'wouldn', "wouldn't"])
+# punctuation, newlines and tabs get replaced with whitespace
+NON_WORD_PATTERN = re.compile(r"[^\w\s]|[\n\t\r]")
+# how many different words to remember stems for. Words are very Zipfian, so most lookups hit the cache
+STEM_CACHE_SIZE = 200000
+# length of the description snippets shown in search results. The crawler stores snippets cut to this, and the
+# search server cuts the descriptions of pages crawled before snippets were stored
+SNIPPET_LENGTH = 200
+
+stemmer = PorterStemmer()
+
+@lru_cache(maxsize=STEM_CACHE_SIZE)
+def stem_word(word):
+    """Returns the token of a word, or None if it's a stop word"""
+    stemmed = stemmer.stem(word, to_lowercase=True)
+    return stemmed if stemmed not in STOP_WORDS else None
+
+def get_words(text, stem=True):
+    """Returns list of tokens in text, in order (repeated words are repeated)"""
+    valid = []
+    # splitting on single spaces leaves empty strings where there were many spaces, we just skip them
+    for word in NON_WORD_PATTERN.sub(" ", text).split(" "):
+        if not word or not word.isascii(): continue
+        if stem:
+            if (stemmed := stem_word(word)) is not None:
+                valid.append(stemmed)
+        elif (lowered := word.lower()) not in STOP_WORDS:
+            valid.append(lowered)
+    return valid
+
+def get_word_counts(text, stem=True):
+    """Returns histogram of token -> count for text"""
+    return Counter(get_words(text, stem))
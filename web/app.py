@@ -1,31 +1,64 @@
-from flask import Flask, render_template, request
+from flask import Flask, render_template, request, jsonify, g, Response
 from flask_cors import CORS
 from database import ImageDatabase, PageTokensDatabase, PagesDatabase, ImageTokensDatabase
-from nltk import PorterStemmer
-import re
+from search import top_k, boost_by_rank
+from analyzer import get_words
+from segment import IndexSegment
+from cache import ResultsCache, Generation, cache_key
+import metrics
+import math
+import os
 
 app = Flask(__name__)
 app.config.from_object("config.Config")
 config = app.config
 cors = CORS(app, origins=config["CORS"])
 
+# has to be before the database clients are made
+metrics.listen_to_mongo()
 pages_db = PagesDatabase()
 images_db = ImageDatabase()
 page_tokens_db = PageTokensDatabase()
 image_tokens_db = ImageTokensDatabase()
 
-STOP_WORDS = set(['', 'i', 'me', 'my', 'myself', 'we', 'our', 'ours', 'ourselves', 'you', "you're", "you've", "you'll", "you'd", 'your', 'yours', 'yourself', 'yourselves', 'he', 'him', 'his', 'himself', 'she', "she's", 'her', 'hers', 'herself', 'it', "it's", 'its', 'itself', 'they', 'them', 'their', 'theirs', 'themselves', 'what', 'which', 'who', 'whom', 'this', 'that', "that'll", 'these', 'those', 'am', 'is', 'are', 'was', 'were', 'be', 'been', 'being', 'have', 'has', 'had', 'having', 'do', 'does', 'did', 'doing', 'a', 'an', 'the', 'and', 'but', 'if', 'or', 'because', 'as', 'until', 'while', 'of', 'at', 'by', 'for', 'with', 'about', 'against', 'between', 'into', 'through', 'during', 'before', 'after', 'above', 'below', 'to', 'from', 'up', 'down', 'in', 'out', 'on', 'off', 'over', 'under', 'again', 'further', 'then', 'once', 'here', 'there', 'when', 'where', 'why', 'how', 'all', 'any', 'both', 'each', 'few', 'more', 'most', 'other', 'some', 'such', 'no', 'nor', 'not', 'only', 'own', 'same', 'so', 'than', 'too', 'very', 's', 't', 'can', 'will', 'just', 'don', "don't", 'should', "should've", 'now', 'd', 'll', 'm', 'o', 're', 've', 'y', 'ain', 'aren', "aren't", 'couldn', "couldn't", 'didn', "didn't", 'doesn', "doesn't", 'hadn', "hadn't", 'hasn', "hasn't", 'haven', "haven't", 'isn', "isn't", 'ma', 'mightn', "mightn't", 'mustn', "mustn't", 'needn', "needn't", 'shan', "shan't", 'shouldn', "shouldn't", 'wasn', "wasn't", 'weren', "weren't", 'won', "won't", 'wouldn', "wouldn't"])
-stemmer = PorterStemmer()
-def get_words(text, stem=True):
-    # get rid of punctuation, replace newlines and tabs with whitespace, and then split by whitespace
-    words = re.split(" +", re.sub("([^\w\s])|(\n)|(\t)|(\r)", " ", text).strip(" "))
-    valid = []
-    for word in words:
-        if not word.isascii(): continue
-        stemmed = stemmer.stem(word, to_lowercase=True) if stem else word.lower()
-        if stemmed not in STOP_WORDS:
-            valid.append(stemmed)
-    return valid
+# serve searches from an exported index segment if there is one, otherwise straight from Mongo
+if config["INDEX_SEGMENT"]:
+    search_index = IndexSegment(config["INDEX_SEGMENT"])
+    get_total_docs = lambda: search_index.num_docs
+else:
+    search_index = page_tokens_db
+    get_total_docs = pages_db.get_estimated_count
+
+# cached results are thrown out when the crawler (or pagerank.py etc) bumps the index generation, or a new segment is exported
+results_cache = ResultsCache(config["CACHE_SIZE"], config["CACHE_TTL"], config["CACHE_PATH"])
+if config["INDEX_SEGMENT"]:
+    generation = Generation(lambda: f"{pages_db.get_generation()}-{os.path.getmtime(config['INDEX_SEGMENT'])}", config["GENERATION_CHECK_INTERVAL"])
+else:
+    generation = Generation(pages_db.get_generation, config["GENERATION_CHECK_INTERVAL"])
+
+metrics.registry.register(metrics.Callback("search_cache_hits_total", "Results cache hits", "counter", lambda: results_cache.hits))
+metrics.registry.register(metrics.Callback("search_cache_shared_hits_total", "Results cache hits from the shared cache", "counter", lambda: results_cache.shared_hits))
+metrics.registry.register(metrics.Callback("search_cache_misses_total", "Results cache misses", "counter", lambda: results_cache.misses))
+metrics.registry.register(metrics.Callback("search_cache_evictions_total", "Results evicted from the cache", "counter", lambda: results_cache.evictions))
+metrics.registry.register(metrics.Callback("search_cache_entries", "Results in the cache", "gauge", lambda: len(results_cache.entries)))
+
+
+@app.before_request
+def start_timer():
+    g.timer = metrics.RequestTimer()
+    g.timer_token = metrics.current_timer.set(g.timer)
+
+@app.after_request
+def add_timing(response):
+    if (timer := g.get("timer", None)) is not None:
+        response.headers["Server-Timing"] = timer.server_timing()
+        timer.observe(request.endpoint or "none")
+    return response
+
+@app.teardown_request
+def stop_timer(exception=None):
+    if (token := g.get("timer_token", None)) is not None:
+        metrics.current_timer.reset(token)
 
 
 @app.route("/", methods=["GET"])
@@ -39,57 +72,65 @@ def about():
 @app.route("/search", methods=["GET"])
 def results():
     query = request.args["query"]
-    query_words = get_words(query)
+    page = max(1, request.args.get("page", 1, type=int))
+    per_page = min(max(1, request.args.get("per_page", config["PER_PAGE"], type=int)), config["MAX_PER_PAGE"])
+    with g.timer.stage("analyze"):
+        query_words = get_words(query)
     print (query_words)
     if len(query_words) == 0:
-        return render_template("results.html", query=query, results=[])
-    query_results = {}
-    for word in query_words:
-        db_results = page_tokens_db.aggregate([
-            {"$match": {"token": word}},
-            {"$project": {"_id": 0, "token": 1, "urls": 1}},
-            {"$unwind": "$urls"},
-            {"$sort": {"urls.count": -1}},
-            {"$skip": 0},
-            {"$limit": 50}
-        ])
-        query_results[word] = {}
-        for result in db_results:
-            try: query_results[word][result["urls"]["url"]] = result["urls"]["count"]
-            # shouldn't theoretically happen, but just in case
-            except Exception as e: pass
-    scored_urls = {}
-    for word in query_words:
-        urls = list(query_results[word].keys())
-        for url in urls:
-            if scored_urls.get(url, None) is None:
-                scored_urls[url] = query_results[word][url]
-                for word2 in query_results:
-                    if word == word2: continue
-                    if query_results[word2].get(url, None) is not None:
-                        scored_urls[url] += query_results[word][url]
-                    else:
-                        count = page_tokens_db.query(
-                            {"token": word2},
-                            {"_id": 0, "token": 0, "urls": {"$elemMatch": {"url": url}}}
-                        )[0]["urls"][0]["count"]
-                        scored_urls[url] += count
-    scored_urls = [{
-        "url": url,
-        "score": scored_urls[url]
-    } for url in list(scored_urls.keys())]
-    ranked_urls = [ranked_url["url"] for ranked_url in sorted(scored_urls, key = lambda url: url["score"], reverse=True)]
-    print (len(ranked_urls), "results")
-    pages = pages_db.query({"url": {"$in": ranked_urls}}, {"_id": 0, "url": 1, "title": 1, "description": 1})
-    pages = {
-        page["url"]: {
-            "url": page["url"],
-            "title": page["title"],
-            "description": page["description"][0:200] + "..." if len(page["description"]) > 200 else page["description"]
-        } for page in pages
-    }
-    ranked_pages = [pages[ranked_url] for ranked_url in ranked_urls]
-    return render_template("results.html", query=query, results=ranked_pages)
+        return render_template("results.html", query=query, results=[], total=0, page=1, pages=1, per_page=per_page)
+    # the ranking is done once per query and cached, every page of results only hydrates its own slice
+    key = cache_key(query_words)
+    # "Cache-Control: no-cache" ranks the query again (the new results are still cached), e.g. for cold load tests
+    use_cache = "no-cache" not in request.headers.get("Cache-Control", "")
+    with g.timer.stage("cache"):
+        current_generation = generation.get()
+        ranked_urls = results_cache.get(key, current_generation) if use_cache else None
+    if ranked_urls is None:
+        metrics.queries.inc(source="ranked")
+        ranked_urls = rank(query_words)
+        results_cache.put(key, current_generation, ranked_urls)
+    else: metrics.queries.inc(source="cache")
+    pages = max(1, math.ceil(len(ranked_urls) / per_page))
+    page = min(page, pages)
+    visible_urls = ranked_urls[(page - 1) * per_page:page * per_page]
+    with g.timer.stage("hydrate"):
+        results = hydrate(visible_urls)
+    with g.timer.stage("render"):
+        return render_template(
+            "results.html", query=query, results=results,
+            total=len(ranked_urls), page=page, pages=pages, per_page=per_page
+        )
+
+@app.route("/metrics", methods=["GET"])
+def metrics_page():
+    return Response(metrics.registry.render(), mimetype="text/plain; version=0.0.4")
+
+@app.route("/cache/stats", methods=["GET"])
+def cache_stats():
+    return jsonify({**results_cache.stats(), "generation": generation.get()})
+
+def rank(query_words) -> list:
+    """Returns urls of pages matching query words, best first"""
+    timer = g.timer
+    with timer.stage("total_docs"):
+        total_docs = get_total_docs()
+    start = timer.elapsed()
+    scored_urls = top_k(metrics.TimedIndex(search_index, timer), query_words, k=config["MAX_RESULTS"], total_docs=total_docs)
+    # whatever top_k didn't spend getting postings was spent scoring
+    timer.add("score", timer.elapsed() - start - timer.stages.get("token_stats", 0) - timer.stages.get("postings", 0))
+    print (len(scored_urls), "results")
+    # only the ranks are needed here, the rest of the page is fetched for the urls that are shown
+    with timer.stage("page_ranks"):
+        pages = pages_db.query({"_id": {"$in": [url for url, score in scored_urls]}}, {"_id": 1, "rank": 1})
+        ranks = {page["_id"]: page.get("rank", None) for page in pages}
+    # pages with a high page rank (see pagerank.py) get moved up
+    return [url for url in boost_by_rank(scored_urls, ranks, config["RANK_WEIGHT"]) if url in ranks]
+
+def hydrate(urls) -> list:
+    """Returns url, title and description (snippet) of pages, in the same order as urls"""
+    pages = pages_db.get_results(urls, config["SNIPPET_LENGTH"])
+    return [pages[url] for url in urls if url in pages]
 
 if __name__ == "__main__":
     print ("=" * 50)
@@ -0,0 +1,163 @@
+"""Async search server (ASGI). Serves the same pages as app.py, but searches with asyncio and Motor:
+postings of all query words are fetched at the same time (see async_top_k), and result pages are fetched while
+scores are being finished. One worker handles many searches at once, instead of one thread per request.
+
+Run from the web directory with any ASGI server, e.g.: uvicorn asgi:app --workers 4
+"""
+from jinja2 import Environment, FileSystemLoader, select_autoescape
+from urllib.parse import parse_qs, urlencode
+from async_database import AsyncPagesDatabase, AsyncPageTokensDatabase
+from search import async_top_k, boost_by_rank
+from analyzer import get_words
+from segment import IndexSegment
+from cache import ResultsCache, AsyncGeneration, cache_key
+from config import Config
+import asyncio
+import json
+import math
+import mimetypes
+import os
+
+WEB_DIR = os.path.dirname(os.path.abspath(__file__))
+STATIC_DIR = os.path.join(WEB_DIR, "static")
+ROUTES = {"index": "/", "about": "/about", "results": "/search"}
+
+def url_for(endpoint, **params):
+    """Just enough of Flask's url_for for the templates"""
+    return ROUTES[endpoint] + ("?" + urlencode(params) if len(params) > 0 else "")
+
+templates = Environment(loader=FileSystemLoader(os.path.join(WEB_DIR, "templates")), autoescape=select_autoescape())
+templates.globals["url_for"] = url_for
+
+results_cache = ResultsCache(Config.CACHE_SIZE, Config.CACHE_TTL, Config.CACHE_PATH)
+# made on startup, since Motor clients have to be made in the server's event loop
+pages_db = None
+page_tokens_db = None
+search_index = None
+generation = None
+
+
+async def startup():
+    global pages_db, page_tokens_db, search_index, generation
+    pages_db = AsyncPagesDatabase()
+    page_tokens_db = AsyncPageTokensDatabase()
+    search_index = IndexSegment(Config.INDEX_SEGMENT) if Config.INDEX_SEGMENT else page_tokens_db
+    async def fetch_generation():
+        if Config.INDEX_SEGMENT: return f"{await pages_db.get_generation()}-{os.path.getmtime(Config.INDEX_SEGMENT)}"
+        return await pages_db.get_generation()
+    generation = AsyncGeneration(fetch_generation, Config.GENERATION_CHECK_INTERVAL)
+
+async def shutdown():
+    pages_db.close_connection()
+    page_tokens_db.close_connection()
+    if Config.INDEX_SEGMENT: search_index.close()
+
+
+async def get_total_docs():
+    if Config.INDEX_SEGMENT: return search_index.num_docs
+    return await pages_db.get_estimated_count()
+
+async def rank(query_words):
+    """Returns (ranked urls, pages already fetched for them as url -> page)"""
+    prefetch = None
+    def start_fetching(urls):
+        nonlocal prefetch
+        # the pages are fetched while async_top_k fills in the last scores, unless too many urls can still make it
+        if len(urls) <= Config.PREFETCH_LIMIT:
+            prefetch = asyncio.ensure_future(pages_db.get_results(urls, Config.SNIPPET_LENGTH))
+    scored_urls = await async_top_k(
+        search_index, query_words,
+        k=Config.MAX_RESULTS,
+        total_docs=await get_total_docs(),
+        on_candidates=start_fetching
+    )
+    pages = await prefetch if prefetch is not None else {}
+    if len(missing := [url for url, score in scored_urls if url not in pages]) > 0:
+        pages.update(await pages_db.get_results(missing, Config.SNIPPET_LENGTH))
+    ranks = {url: page.get("rank", None) for url, page in pages.items()}
+    # pages with a high page rank (see pagerank.py) get moved up
+    return [url for url in boost_by_rank(scored_urls, ranks, Config.RANK_WEIGHT) if url in pages], pages
+
+async def results(params, headers):
+    if "query" not in params: return 400, "text/plain", b"Missing query"
+    query = params["query"]
+    try: page = max(1, int(params.get("page", 1)))
+    except ValueError: page = 1
+    try: per_page = min(max(1, int(params.get("per_page", Config.PER_PAGE))), Config.MAX_PER_PAGE)
+    except ValueError: per_page = Config.PER_PAGE
+    query_words = get_words(query)
+    if len(query_words) == 0:
+        return render("results.html", query=query, results=[], total=0, page=1, pages=1, per_page=per_page)
+    key = cache_key(query_words)
+    current_generation = await generation.get()
+    pages = {}
+    # "Cache-Control: no-cache" ranks the query again (the new results are still cached), e.g. for cold load tests
+    use_cache = "no-cache" not in headers.get("cache-control", "")
+    if (ranked_urls := results_cache.get(key, current_generation) if use_cache else None) is None:
+        ranked_urls, pages = await rank(query_words)
+        results_cache.put(key, current_generation, ranked_urls)
+    total_pages = max(1, math.ceil(len(ranked_urls) / per_page))
+    page = min(page, total_pages)
+    visible_urls = ranked_urls[(page - 1) * per_page:page * per_page]
+    if len(missing := [url for url in visible_urls if url not in pages]) > 0:
+        pages.update(await pages_db.get_results(missing, Config.SNIPPET_LENGTH))
+    return render(
+        "results.html", query=query, results=[pages[url] for url in visible_urls if url in pages],
+        total=len(ranked_urls), page=page, pages=total_pages, per_page=per_page
+    )
+
+async def cache_stats(params):
+    body = json.dumps({**results_cache.stats(), "generation": await generation.get()})
+    return 200, "application/json", body.encode("utf-8")
+
+def render(template, **context):
+    return 200, "text/html; charset=utf-8", templates.get_template(template).render(**context).encode("utf-8")
+
+def read_file(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+async def static(path):
+    # static files are small, but don't block the event loop on the disk anyway
+    full_path = os.path.realpath(os.path.join(STATIC_DIR, path[len("/static/"):]))
+    if not full_path.startswith(STATIC_DIR + os.sep) or not os.path.isfile(full_path):
+        return 404, "text/plain", b"Not found"
+    body = await asyncio.get_running_loop().run_in_executor(None, read_file, full_path)
+    return 200, mimetypes.guess_type(full_path)[0] or "application/octet-stream", body
+
+
+async def handle(path, params, headers):
+    if path == "/": return render("index.html")
+    if path == "/about": return render("about.html")
+    if path == "/search": return await results(params, headers)
+    if path == "/cache/stats": return await cache_stats(params)
+    if path.startswith("/static/"): return await static(path)
+    return 404, "text/plain", b"Not found"
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await startup()
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await shutdown()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan": return await lifespan(receive, send)
+    if scope["type"] != "http": return
+    params = {key: values[-1] for key, values in parse_qs(scope["query_string"].decode("utf-8")).items()}
+    # ASGI header names are lowercase
+    headers = {name.decode("latin-1"): value.decode("latin-1") for name, value in scope["headers"]}
+    try: status, content_type, body = await handle(scope["path"], params, headers)
+    except Exception as e:
+        print ("- Error handling", scope["path"], e)
+        status, content_type, body = 500, "text/plain", b"Internal server error"
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", content_type.encode("utf-8")), (b"content-length", str(len(body)).encode("utf-8"))]
+    })
+    await send({"type": "http.response.body", "body": body})
@@ -0,0 +1,87 @@
+"""Async (Motor) counterparts of the databases the search server reads from, used by asgi.py.
+Only reading is supported, the crawler still writes with database.py
+"""
+from motor.motor_asyncio import AsyncIOMotorClient
+from database import PageTokensDatabase, PagesDatabase, TopPostings
+from config import Config
+
+
+class AsyncDatabase:
+    """Like Database, but every query is a coroutine. Clients have to be made inside the running event loop
+
+    :param collection_name: the name of collection to use in database (connection settings come from Config.MONGO)
+    :type: str
+    """
+
+    # one client per url, like Database
+    connections = {}
+
+    def __init__(self, collection_name) -> None:
+        connection = Config.MONGO["URL"]
+        if AsyncDatabase.connections.get(connection, None) is None:
+            AsyncDatabase.connections[connection] = {
+                "client": AsyncIOMotorClient(connection, **Config.MONGO["AUTHENTICATION"]),
+                "total": 1
+            }
+            print ("- Connected to database (async)")
+        else:
+            AsyncDatabase.connections[connection]["total"] += 1
+        self.connection = connection
+        self.database = AsyncDatabase.connections[connection]["client"][Config.MONGO["NAME"]]
+        self.collection = self.database[collection_name]
+
+    async def query(self, query={}, projection={}, skip=0, limit=0, sort=None) -> list:
+        return await self.collection.find(filter=query, projection=projection, skip=skip, limit=limit, sort=sort).to_list(None)
+
+    async def aggregate(self, pipeline, **kwargs) -> list:
+        return await self.collection.aggregate(pipeline, **kwargs).to_list(None)
+
+    async def get_count(self, filters={}) -> int:
+        return await self.collection.count_documents(filters)
+
+    async def get_estimated_count(self) -> int:
+        return await self.collection.estimated_document_count()
+
+    async def get_generation(self) -> int:
+        """See Database.get_generation"""
+        doc = await self.database[Config.MONGO["META_COLLECTION"]].find_one({"_id": "index_generation"})
+        return doc["generation"] if doc is not None else 0
+
+    def close_connection(self):
+        if AsyncDatabase.connections.get(self.connection):
+            AsyncDatabase.connections[self.connection]["total"] -= 1
+            if AsyncDatabase.connections[self.connection]["total"] <= 0:
+                try: AsyncDatabase.connections[self.connection]["client"].close()
+                except: pass
+                del AsyncDatabase.connections[self.connection]
+
+
+class AsyncPagesDatabase(AsyncDatabase):
+    def __init__(self) -> None:
+        super().__init__(Config.MONGO["PAGES_COLLECTION"])
+
+    async def get_results(self, urls: list, snippet_length=200) -> dict:
+        """See PagesDatabase.get_results"""
+        return {page["url"]: page for page in await self.aggregate(PagesDatabase.results_pipeline(urls, snippet_length))}
+
+
+class AsyncPageTokensDatabase(AsyncDatabase):
+    def __init__(self) -> None:
+        super().__init__(Config.MONGO["PAGE_TOKENS_COLLECTION"])
+
+    async def get_token_stats(self, tokens: list) -> dict:
+        """See PageTokensDatabase.get_token_stats"""
+        return PageTokensDatabase.read_token_stats(await self.aggregate(PageTokensDatabase.token_stats_pipeline(tokens)))
+
+    async def get_token_postings(self, token: str, min_count=0, urls=[]) -> dict:
+        """See PageTokensDatabase.get_token_postings"""
+        return PageTokensDatabase.read_postings(await self.aggregate(PageTokensDatabase.token_postings_pipeline(token, min_count, urls)))
+
+    async def get_top_postings(self, token: str, k=50) -> tuple:
+        """See PageTokensDatabase.get_top_postings"""
+        top = TopPostings(k)
+        async for doc in self.collection.find(**PageTokensDatabase.top_postings_query(token, k)):
+            if top.done(doc["max_count"]): break
+            for url_elem in doc["urls"]:
+                top.add(url_elem["url"], url_elem["count"])
+        return top.postings, top.bound
@@ -0,0 +1,131 @@
+"""Cache of search results, so popular queries don't get ranked and hydrated again on every search
+
+Results are kept in memory (bounded, least recently used ones are thrown out first) for at most `ttl` seconds.
+If a path is given, results are also kept in a sqlite file there, so every server worker process can use results
+any of them found. Every result is saved with the index generation it was made from (see Database.get_generation),
+and is only used while the generation is the same, so new crawls show up without waiting for the ttl.
+"""
+from collections import OrderedDict
+import json
+import sqlite3
+import threading
+import time
+
+
+def cache_key(terms: list) -> str:
+    """Queries with the same stemmed terms (in any order) have the same results"""
+    return " ".join(sorted(set(terms)))
+
+
+class ResultsCache:
+    def __init__(self, max_entries=1000, ttl=300, path=None) -> None:
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = self.shared_hits = self.misses = self.evictions = 0
+        self.db = None
+        if path:
+            self.db_lock = threading.Lock()
+            self.db = sqlite3.connect(path, timeout=5, isolation_level=None, check_same_thread=False)
+            # WAL so workers can read while another one writes
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, generation TEXT, expires REAL, value TEXT)")
+            self.writes = 0
+
+    def get(self, key: str, generation):
+        """Returns cached value of key, or None if there isn't one for this generation"""
+        now = time.time()
+        generation = str(generation)
+        with self.lock:
+            if (entry := self.entries.get(key, None)) is not None:
+                expires, entry_generation, value = entry
+                if expires > now and entry_generation == generation:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self.entries[key]
+        if self.db is not None:
+            with self.db_lock:
+                row = self.db.execute(
+                    "SELECT expires, value FROM results WHERE key = ? AND generation = ? AND expires > ?",
+                    (key, generation, now)
+                ).fetchone()
+            if row is not None:
+                value = json.loads(row[1])
+                with self.lock:
+                    self.put_local(key, generation, row[0], value)
+                    self.hits += 1
+                    self.shared_hits += 1
+                return value
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def put(self, key: str, generation, value):
+        """Caches value of key (has to be json serializable if the cache is shared)"""
+        expires = time.time() + self.ttl
+        generation = str(generation)
+        with self.lock:
+            self.put_local(key, generation, expires, value)
+        if self.db is not None:
+            with self.db_lock:
+                self.db.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)", (key, generation, expires, json.dumps(value)))
+                self.writes += 1
+                # trim once in a while, not on every write
+                if self.writes % 100 == 0: self.trim()
+
+    def put_local(self, key, generation, expires, value):
+        self.entries[key] = (expires, generation, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def trim(self):
+        """Drops expired results from the shared cache, and the ones closest to expiring if it's over max_entries"""
+        self.db.execute("DELETE FROM results WHERE expires <= ?", (time.time(),))
+        self.db.execute(
+            "DELETE FROM results WHERE key NOT IN (SELECT key FROM results ORDER BY expires DESC LIMIT ?)",
+            (self.max_entries,)
+        )
+
+    def stats(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "shared_hits": self.shared_hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups > 0 else 0,
+                "evictions": self.evictions,
+                "entries": len(self.entries),
+                "max_entries": self.max_entries,
+                "ttl": self.ttl
+            }
+
+
+class Generation:
+    """Index generation, fetched at most once every `interval` seconds so searches don't all ask the database"""
+    def __init__(self, fetch, interval=5) -> None:
+        self.fetch = fetch
+        self.interval = interval
+        self.value = None
+        self.checked = 0
+
+    def get(self):
+        if time.time() - self.checked >= self.interval:
+            try: self.value = self.fetch()
+            except Exception as e: pass
+            self.checked = time.time()
+        return self.value
+
+
+class AsyncGeneration(Generation):
+    """Generation with a coroutine function to fetch it"""
+    async def get(self):
+        if time.time() - self.checked >= self.interval:
+            try: self.value = await self.fetch()
+            except Exception as e: pass
+            self.checked = time.time()
+        return self.value
@@ -1,9 +1,30 @@
+from analyzer import SNIPPET_LENGTH
 import os
 from dotenv import load_dotenv
 load_dotenv()
 
 class Config(object):
     CORS = "*"
+    # how many ranked results a search returns at most
+    MAX_RESULTS = int(os.getenv("MAX_RESULTS", 100))
+    # results shown per page by default, and the most a page can ask for (with per_page)
+    PER_PAGE = int(os.getenv("RESULTS_PER_PAGE", 10))
+    MAX_PER_PAGE = 50
+    # length of descriptions shown for pages that don't have a stored snippet (same as the crawler's snippets)
+    SNIPPET_LENGTH = SNIPPET_LENGTH
+    # how much page rank (see pagerank.py) boosts results. 0 to rank only by tokens
+    RANK_WEIGHT = float(os.getenv("RANK_WEIGHT", 0.5))
+    # path to an index segment (made with segment.py) to search instead of the page tokens collection
+    INDEX_SEGMENT = os.getenv("INDEX_SEGMENT_PATH", "")
+    # how many queries' results are cached, and for how long (secs)
+    CACHE_SIZE = int(os.getenv("RESULTS_CACHE_SIZE", 1000))
+    CACHE_TTL = float(os.getenv("RESULTS_CACHE_TTL", 300))
+    # sqlite file to share cached results between server workers. Leave blank to cache in each worker only
+    CACHE_PATH = os.getenv("RESULTS_CACHE_PATH", "")
+    # how often (secs) to check if the index changed
+    GENERATION_CHECK_INTERVAL = float(os.getenv("GENERATION_CHECK_INTERVAL", 5))
+    # (async server) start fetching result pages while scores are finished, if at most this many urls can make it
+    PREFETCH_LIMIT = 4 * MAX_RESULTS
 
     MONGO = {
         "URL": os.getenv("MONGODB_URL", "mongodb://127.0.0.1:27017"),
@@ -17,6 +38,7 @@ class Config(object):
         "IMAGES_COLLECTION": os.getenv("MONGODB_IMAGES_COLLECTION", "images"),
         "PAGE_TOKENS_COLLECTION": os.getenv("MONGODB_PAGE_TOKENS_COLLECTION", "page_tokens"),
         "IMAGE_TOKENS_COLLECTION": os.getenv("MONGODB_IMAGE_TOKENS_COLLECTION", "image_tokens"),
+        "META_COLLECTION": os.getenv("MONGODB_META_COLLECTION", "meta"),
     }
     if authMech := os.getenv("MONGODB_AUTH_MECH", None):
         MONGO["AUTHENTICATION"]["authMechanism"] = authMech
\ No newline at end of file
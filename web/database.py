@@ -1,6 +1,10 @@
 from pymongo import MongoClient
-from pymongo import ReplaceOne, UpdateOne, InsertOne
+from pymongo import UpdateOne, UpdateMany, ASCENDING, DESCENDING
+import heapq
 import os
+import queue
+import threading
+import time
 from dotenv import load_dotenv
 load_dotenv()
 
@@ -22,7 +26,15 @@ class Database:
     :param db_buffer_size: how many items the database will store locally until it dumps to the database
     :type: int
     
-    :param db_upload_delay: how long to wait before sending items continuously
+    :param db_upload_delay: how long (secs) items can sit in the buffer before they are sent anyway. 0 to only send when the buffer is full
+    :type: int
+
+    :param async_writes: send items to the database from a background writer thread, so inserts don't wait on the database.
+        The writer takes buffers from a queue of at most `write_queue_size` buffers. If the database falls behind and the queue is full,
+        inserts will wait until there's room again
+    :type: bool
+
+    :param write_queue_size: how many full buffers can wait to be written in the background
     :type: int
     """
 
@@ -36,7 +48,9 @@ class Database:
         connection="mongodb://127.0.0.1:27017",
         authentication={"username": "", "password": "", "authSource": ""},
         db_buffer_size=100,
-        db_upload_delay=0
+        db_upload_delay=0,
+        async_writes=False,
+        write_queue_size=4
     ) -> None:
         """Setup MongoDB with connection. Get documents from collection in database"""
         if Database.connections.get(connection, None) is None:
@@ -52,8 +66,24 @@ class Database:
         self.database = Database.connections[connection]["client"][database_name]
         self.collection = self.database[collection_name]
         self.buffer = []
+        self.buffer_size = 0
+        self.buffer_lock = threading.Lock()
         self.max_buffer = db_buffer_size
         self.upload_delay = db_upload_delay
+        self.last_push = time.time()
+        # write telemetry (see get_write_stats)
+        self.flushes = 0
+        self.flushed_items = 0
+        self.flush_seconds = 0
+        self.max_flush_seconds = 0
+        self.write_errors = 0
+        self.writer = None
+        # held by the writer while it sends old items, so wait_for_writes knows when they're written
+        self.flush_lock = threading.Lock()
+        if async_writes:
+            self.write_queue = queue.Queue(maxsize=write_queue_size)
+            self.writer = threading.Thread(target=self.write_loop, name=f"{collection_name}-writer", daemon=True)
+            self.writer.start()
 
     def check_if_exists(self, url: str) -> bool:
         """Returns true if url exists in database, else false"""
@@ -61,38 +91,130 @@ class Database:
         return self.collection.count_documents({"url": url}) != 0
 
     def insert(self, item):
-        self.buffer.append(item)
-        # if we are over our buffer limit, send all items to the database
-        if len(self.buffer) >= self.max_buffer:
+        with self.buffer_lock:
+            self.buffer.append(item)
+            self.buffer_size += self.item_size(item)
+        # if we are over our buffer limit (or items waited long enough), send all items to the database
+        if self.should_push():
             self.push_to_db()
 
     def insert_many(self, items: list):
-        self.buffer += items
-        if len(self.buffer) >= self.max_buffer:
+        with self.buffer_lock:
+            self.buffer += items
+            self.buffer_size += sum(self.item_size(item) for item in items)
+        if self.should_push():
             self.push_to_db()
 
+    def item_size(self, item) -> int:
+        """How much an item counts towards the buffer size"""
+        return 1
+
+    def should_push(self) -> bool:
+        if self.buffer_size >= self.max_buffer: return True
+        return self.upload_delay > 0 and time.time() - self.last_push >= self.upload_delay
+
     def query(self, query={}, projection={}, skip=0, limit=0, sort=None) -> list:
         """Returns list of results from database based on query. Leave parameter blank to get all documents"""
         query_result = list(self.collection.find(filter=query, projection=projection, skip=skip, limit=limit, sort=sort))
         return list(query_result)
     
-    def aggregate(self, pipeline) -> list:
+    def aggregate(self, pipeline, **kwargs) -> list:
         """Returns a list of results from MongoDB aggregation"""
-        return list(self.collection.aggregate(pipeline))
+        return list(self.collection.aggregate(pipeline, **kwargs))
 
     def get_count(self, filters={}) -> int:
         """Returns number of docs in collection with filters (leave blank to get all docs)"""
         return self.collection.count_documents(filters)
 
+    def get_estimated_count(self) -> int:
+        """Returns estimated number of docs in collection (uses collection metadata, so it's fast)"""
+        return self.collection.estimated_document_count()
+
+    def get_generation(self) -> int:
+        """Returns the index generation: a counter that's bumped whenever the index changes, so caches know to throw out results"""
+        doc = self.database[os.getenv("MONGODB_META_COLLECTION", "meta")].find_one({"_id": "index_generation"})
+        return doc["generation"] if doc is not None else 0
+
+    def bump_generation(self):
+        self.database[os.getenv("MONGODB_META_COLLECTION", "meta")].update_one(
+            {"_id": "index_generation"}, {"$inc": {"generation": 1}}, upsert=True
+        )
+
+    def take_buffer(self):
+        """Returns the buffered items, and starts a new empty buffer"""
+        with self.buffer_lock:
+            batch = self.buffer
+            self.buffer = type(batch)()
+            self.buffer_size = 0
+            self.last_push = time.time()
+        return batch
+
     def push_to_db(self):
-        """Dumps everything from buffer to the db"""
+        """Dumps everything from buffer to the db (or hands it to the writer thread if using async writes)"""
         if len(self.buffer) == 0: return
-        try: self.collection.insert_many(self.buffer, ordered=False)
-        except Exception: pass
-        self.buffer *= 0
+        batch = self.take_buffer()
+        if self.writer is None: self.flush(batch)
+        # blocks if the writer is behind, so we don't keep piling up buffers in memory
+        else: self.write_queue.put(batch)
+
+    def flush(self, batch):
+        """Writes a batch, keeping track of how many items were written and how long it took"""
+        start = time.perf_counter()
+        self.write(batch)
+        seconds = time.perf_counter() - start
+        self.flushes += 1
+        self.flushed_items += len(batch)
+        self.flush_seconds += seconds
+        self.max_flush_seconds = max(self.max_flush_seconds, seconds)
+
+    def write(self, batch):
+        """Sends a batch of buffered items to the db"""
+        try: self.collection.insert_many(batch, ordered=False)
+        except Exception: self.write_errors += 1
+
+    def get_write_stats(self) -> dict:
+        """Returns buffer depth and write telemetry (flush counts and latency, batch sizes, write errors)"""
+        return {
+            "buffered": self.buffer_size,
+            "queued_batches": self.write_queue.qsize() if self.writer is not None else 0,
+            "flushes": self.flushes,
+            "flushed_items": self.flushed_items,
+            "flush_seconds": self.flush_seconds,
+            "max_flush_seconds": self.max_flush_seconds,
+            "write_errors": self.write_errors
+        }
+
+    def write_loop(self):
+        """Writer thread for async writes. Writes buffers as they come in, and sends old items if nothing came in for a while"""
+        while True:
+            try: batch = self.write_queue.get(timeout=self.upload_delay if self.upload_delay > 0 else None)
+            except queue.Empty:
+                with self.flush_lock:
+                    if len(self.buffer) > 0 and self.should_push():
+                        self.flush(self.take_buffer())
+                continue
+            # None means we're closing
+            if batch is None:
+                self.write_queue.task_done()
+                break
+            self.flush(batch)
+            self.write_queue.task_done()
+
+    def wait_for_writes(self):
+        """Pushes the buffer, then waits until the writer thread has written everything"""
+        self.push_to_db()
+        if self.writer is not None:
+            self.write_queue.join()
+            # the writer may have taken the buffer itself (items waited too long), and still be writing it
+            with self.flush_lock: pass
 
     def close_connection(self):
         """Removes this connection from client. If client has no more connections, close it"""
+        if self.writer is not None:
+            self.wait_for_writes()
+            self.write_queue.put(None)
+            self.writer.join()
+            self.writer = None
         if Database.connections.get(self.connection):
             Database.connections[self.connection]["total"] -= 1
             if Database.connections[self.connection]["total"] <= 0:
@@ -105,7 +227,12 @@ class Database:
 
 
 class PagesDatabase(Database):
-    def __init__(self, db_buffer_size=100, db_upload_delay=0):
+    """Pages are upserted by url: content is set, and backlinks are merged with any already there.
+    That way it doesn't matter if BacklinksDatabase already upserted a doc with only backlinks for the page
+
+    :param count_backlinks: also keep a `backlink_count` field on pages (needs MongoDB 4.2+)
+    """
+    def __init__(self, db_buffer_size=100, db_upload_delay=0, async_writes=False, write_queue_size=4, count_backlinks=False):
         auth = {
             "username": os.getenv("MONGODB_USER", ""),
             "password": os.getenv("MONGODB_PWD", ""),
@@ -117,34 +244,65 @@ class PagesDatabase(Database):
             os.getenv("MONGODB_NAME", "db_name"),
             os.getenv("MONGODB_PAGES_COLLECTION", "pages"),
             os.getenv("MONGODB_URL", "mongodb://127.0.0.1:27017"),
-            auth, db_buffer_size, db_upload_delay
+            auth, db_buffer_size, db_upload_delay, async_writes, write_queue_size
         )
+        self.count_backlinks = count_backlinks
 
-    def push_to_db(self):
-        if len(self.buffer) == 0: return
-        try: self.collection.insert_many(self.buffer, ordered=False)
-        except Exception as e:
-            # some write operations may not work because the pages_buffer hasn't been pushed yet (they go at different rates)
-            # they are upsert operations, meaning that the docs in database aren't complete. We should update them to include content
-            # NOTE: we don't handle docs that happen to have same url but different content (yet)
-            dup_docs = [error["op"] for error in e.details["writeErrors"]]
-            docs_to_update = self.query({"url": {"$in": [doc["url"] for doc in dup_docs]}}, {"_id": 0, "url": 1, "title": 1, "backlinks": 1})
-            replace_docs = []
-            for doc in dup_docs:
-                for doc_to_update in docs_to_update:
-                    if doc["url"] == doc_to_update["url"] and doc_to_update.get("title", None) is None:
-                        try:
-                            doc["backlinks"] += doc_to_update["backlinks"]
-                            doc["backlinks"] = list(set(doc["backlinks"]))
-                            replace_docs.append(ReplaceOne({"url": doc["url"]}, doc))
-                        except: pass
-            try: self.collection.bulk_write(replace_docs, ordered=False)
-            except: pass
-        self.buffer *= 0
+    def upsert_page(self, url: str, backlinks, content={}) -> UpdateOne:
+        """Returns an upsert that sets content of page and adds backlinks to it"""
+        if self.count_backlinks:
+            # update with a pipeline, so the count can be worked out from the merged backlinks.
+            # Values are wrapped in $literal, otherwise strings starting with $ would be read as field names
+            return UpdateOne({"_id": url}, [
+                {"$set": {
+                    **{key: {"$literal": value} for key, value in content.items()},
+                    "url": url,
+                    "backlinks": {"$setUnion": [{"$ifNull": ["$backlinks", []]}, list(backlinks)]}
+                }},
+                {"$set": {"backlink_count": {"$size": "$backlinks"}}}
+            ], upsert=True)
+        return UpdateOne(
+            {"_id": url},
+            {
+                "$set": {**content, "url": url},
+                "$addToSet": {"backlinks": {"$each": list(backlinks)}}
+            },
+            upsert=True
+        )
+
+    @staticmethod
+    def results_pipeline(urls: list, snippet_length=200) -> list:
+        """Pipeline that gets what search results show of pages: url, title, description (snippet) and rank"""
+        return [
+            {"$match": {"_id": {"$in": urls}}},
+            {"$project": {
+                "_id": 0, "url": 1, "title": 1, "rank": 1,
+                # pages crawled before snippets were stored get one cut from their description by the database
+                "description": {"$ifNull": ["$snippet", {"$cond": [
+                    {"$gt": [{"$strLenCP": "$description"}, snippet_length]},
+                    {"$concat": [{"$substrCP": ["$description", 0, snippet_length]}, "..."]},
+                    "$description"
+                ]}]}
+            }}
+        ]
+
+    def get_results(self, urls: list, snippet_length=200) -> dict:
+        """Returns dict of url -> url, title, description (snippet) and rank of pages"""
+        return {page["url"]: page for page in self.aggregate(self.results_pipeline(urls, snippet_length))}
+
+    def write(self, batch):
+        # everything goes in one bulk write, no matter if the page is new or not
+        updates = [self.upsert_page(
+            doc["url"],
+            doc.get("backlinks", []),
+            {key: value for key, value in doc.items() if key not in ("_id", "url", "backlinks")}
+        ) for doc in batch]
+        try: self.collection.bulk_write(updates, ordered=False)
+        except Exception as e: self.write_errors += 1
 
 
 class ImageDatabase(Database):
-    def __init__(self, db_buffer_size=100, db_upload_delay=0):
+    def __init__(self, db_buffer_size=100, db_upload_delay=0, async_writes=False, write_queue_size=4):
         auth = {
             "username": os.getenv("MONGODB_USER", ""),
             "password": os.getenv("MONGODB_PWD", ""),
@@ -156,12 +314,43 @@ class ImageDatabase(Database):
             os.getenv("MONGODB_NAME", "db_name"),
             os.getenv("MONGODB_IMAGES_COLLECTION", "images"),
             os.getenv("MONGODB_URL", "mongodb://127.0.0.1:27017"),
-            auth, db_buffer_size, db_upload_delay
+            auth, db_buffer_size, db_upload_delay, async_writes, write_queue_size
         )
 
 
+class TopPostings:
+    """Collects postings of a token from groups (buckets, blocks) read from the highest max count down,
+    until the k best counts are known: a group whose max count isn't above the k-th best count read can't add to them
+    """
+    def __init__(self, k) -> None:
+        self.k = k
+        self.postings = {}
+        # min heap of the k best counts read
+        self.counts = []
+        # highest count a posting that wasn't read can have
+        self.bound = 0
+
+    def done(self, max_count) -> bool:
+        """Returns True if the next group (with max_count) doesn't need to be read"""
+        if len(self.counts) < self.k or self.counts[0] < max_count: return False
+        self.bound = max_count
+        return True
+
+    def add(self, url, count):
+        self.postings[url] = count
+        if len(self.counts) < self.k: heapq.heappush(self.counts, count)
+        elif count > self.counts[0]: heapq.heapreplace(self.counts, count)
+
+
 class PageTokensDatabase(Database):
-    def __init__(self, db_buffer_size=100, db_upload_delay=0):
+    """Token postings are stored in buckets: each token has one or more docs holding at most `bucket_size` urls,
+    sorted by count. New postings are pushed into whichever bucket of the token still has room (or a new one),
+    so writes never need to read the token first, and docs never grow past the 16 MB limit. A url that was crawled
+    again has its old posting pulled out first, so its newest count replaces the old one (like the offline build).
+    Each bucket keeps its `size` and `max_count`, so readers can skip buckets that can't have good postings.
+    Use `migrate_tokens.py` to convert old one-doc-per-token collections, or to re-sort buckets by count
+    """
+    def __init__(self, db_buffer_size=100, db_upload_delay=0, bucket_size=1000, async_writes=False, write_queue_size=4):
         auth = {
             "username": os.getenv("MONGODB_USER", ""),
             "password": os.getenv("MONGODB_PWD", ""),
@@ -173,98 +362,200 @@ class PageTokensDatabase(Database):
             os.getenv("MONGODB_NAME", "db_name"),
             os.getenv("MONGODB_PAGE_TOKENS_COLLECTION", "page_tokens"),
             os.getenv("MONGODB_URL", "mongodb://127.0.0.1:27017"),
-            auth, db_buffer_size, db_upload_delay
+            auth, db_buffer_size, db_upload_delay, async_writes, write_queue_size
         )
+        self.bucket_size = bucket_size
+
+    def item_size(self, item) -> int:
+        """Items are token histograms of a url, like {"url": url, "tokens": {token: count}}.
+        The buffer size is counted in postings (unique token and url pairs), not histograms
+        """
+        return len(item["tokens"])
+
+    @staticmethod
+    def create_indexes(collection):
+        """Indexes readers need on a token collection"""
+        collection.create_index([("token", ASCENDING), ("max_count", DESCENDING), ("size", ASCENDING)], name="token_buckets")
+        collection.create_index([("token", ASCENDING), ("urls.url", ASCENDING)], name="token_urls")
+
+    @staticmethod
+    def make_buckets(token: str, postings: list, bucket_size=1000) -> list:
+        """Splits a token's postings (list of {"url", "count"}) into bucket docs, highest counts in the first buckets"""
+        postings = sorted(postings, key=lambda posting: posting["count"], reverse=True)
+        return [{
+            "token": token,
+            "size": len(postings[i:i + bucket_size]),
+            "max_count": postings[i]["count"],
+            "urls": postings[i:i + bucket_size]
+        } for i in range(0, len(postings), bucket_size)]
 
-    def query_urls_in_tokens(self, tokens: list, urls: list):
-        return list(self.aggregate([
+    @staticmethod
+    def token_stats_pipeline(tokens: list) -> list:
+        return [
             {"$match": {"token": {"$in": tokens}}},
+            {"$group": {"_id": "$token", "df": {"$sum": "$size"}, "max_count": {"$max": "$max_count"}}}
+        ]
+
+    @staticmethod
+    def read_token_stats(docs) -> dict:
+        return {doc["_id"]: {"df": doc["df"], "max_count": doc["max_count"]} for doc in docs}
+
+    @staticmethod
+    def token_postings_pipeline(token: str, min_count=0, urls=[]) -> list:
+        return [
+            # only touch buckets that can have postings we want
+            {"$match": {"token": token, "$or": [
+                {"max_count": {"$gte": min_count}},
+                {"urls.url": {"$in": urls}}
+            ]}},
             {"$project": {
-                "_id": 0, "token": 1,
+                "_id": 0,
                 "urls": {
                     "$filter": {
                         "input": "$urls",
                         "as": "url_elem",
-                        "cond": {"$in": ["$$url_elem.url", urls]}
+                        "cond": {"$or": [
+                            {"$gte": ["$$url_elem.count", min_count]},
+                            {"$in": ["$$url_elem.url", urls]}
+                        ]}
                     }
                 }
             }}
-        ]))
+        ]
 
-    def push_to_db(self):
-        if len(self.buffer) == 0: return
+    @staticmethod
+    def read_postings(docs) -> dict:
+        return {url_elem["url"]: url_elem["count"] for doc in docs for url_elem in doc["urls"]}
+
+    @staticmethod
+    def pull_urls_update(token: str, urls: list) -> UpdateMany:
+        """Update that takes the postings of urls out of a token's buckets, keeping size and max_count right"""
+        return UpdateMany(
+            {"token": token, "urls.url": {"$in": urls}},
+            [
+                {"$set": {"urls": {"$filter": {"input": "$urls", "as": "url_elem", "cond": {"$not": {"$in": ["$$url_elem.url", urls]}}}}}},
+                {"$set": {"size": {"$size": "$urls"}, "max_count": {"$ifNull": [{"$max": "$urls.count"}, 0]}}}
+            ]
+        )
+
+    @staticmethod
+    def top_postings_query(token: str, k=50, bucket_size=1000) -> dict:
+        """find() args for a token's buckets, highest max_count first (uses the token_buckets index).
+        Enough buckets for k postings (and the next one's max_count) usually come in the first batch
+        """
+        return {
+            "filter": {"token": token},
+            "projection": {"_id": 0, "urls": 1, "max_count": 1},
+            "sort": [("max_count", DESCENDING)],
+            "batch_size": k // bucket_size + 2
+        }
+
+    @staticmethod
+    def postings_batch_pipeline(requests: dict) -> list:
+        """Like token_postings_pipeline, for many tokens at once (dict of token -> (min_count, urls)).
+        Each token's $match is its own branch of the $or, so every branch still uses the token_buckets index
+        """
+        return [
+            {"$match": {"$or": [
+                {"token": token, "$or": [{"max_count": {"$gte": min_count}}, {"urls.url": {"$in": urls}}]}
+                for token, (min_count, urls) in requests.items()
+            ]}},
+            {"$project": {
+                "_id": 0,
+                "token": 1,
+                "urls": {
+                    "$filter": {
+                        "input": "$urls",
+                        "as": "url_elem",
+                        "cond": {"$switch": {
+                            "branches": [{
+                                "case": {"$eq": ["$token", token]},
+                                "then": {"$or": [
+                                    {"$gte": ["$$url_elem.count", min_count]},
+                                    {"$in": ["$$url_elem.url", urls]}
+                                ]}
+                            } for token, (min_count, urls) in requests.items()],
+                            "default": False
+                        }}
+                    }
+                }
+            }}
+        ]
+
+    @staticmethod
+    def read_postings_batch(docs, tokens) -> dict:
+        buckets = {token: [] for token in tokens}
+        for doc in docs:
+            buckets[doc["token"]].append(doc)
+        return {token: PageTokensDatabase.read_postings(token_docs) for token, token_docs in buckets.items()}
+
+    def get_token_stats(self, tokens: list) -> dict:
+        """Returns dict of token -> {"df": number of urls with token, "max_count": highest count of token in a url}"""
+        return self.read_token_stats(self.aggregate(self.token_stats_pipeline(tokens)))
+
+    def get_token_postings(self, token: str, min_count=0, urls=[]) -> dict:
+        """Returns dict of url -> count for a token. Only urls with at least min_count, or urls in `urls` are returned"""
+        return self.read_postings(self.aggregate(self.token_postings_pipeline(token, min_count, urls)))
+
+    def get_top_postings(self, token: str, k=50) -> tuple:
+        """Reads a token's buckets from the highest max_count down, until the k best postings are known.
+        Returns (postings, bound): dict of url -> count of the buckets read, and the highest count
+        a posting that wasn't read can have (0 if every bucket was read)
+        """
+        top = TopPostings(k)
+        for doc in self.collection.find(**self.top_postings_query(token, k, self.bucket_size)):
+            if top.done(doc["max_count"]): break
+            for url_elem in doc["urls"]:
+                top.add(url_elem["url"], url_elem["count"])
+        return top.postings, top.bound
+
+    def get_postings_batch(self, requests: dict) -> dict:
+        """get_token_postings of many tokens (dict of token -> (min_count, urls)) in one aggregation.
+        Returns dict of token -> postings"""
+        if len(requests) == 0: return {}
+        return self.read_postings_batch(self.aggregate(self.postings_batch_pipeline(requests)), requests.keys())
+
+    def write(self, batch):
         try:
-            # First, we add up counts for tokens and urls. We use a dict so that we can keep uniqueness
+            # First, we turn the histograms of each url into postings of each token
+            # (the same url can show up more than once, e.g. an image used on many pages, so add them up)
             tokens = {}
-            unique_urls = set()
-            for token_doc in self.buffer:
-                token = token_doc["token"]
-                url = token_doc["url"]
-                unique_urls.add(url)
-                if tokens.get(token, None) is None:
-                    tokens[token] = {
-                        "token": token,
-                        "urls": {
-                            url: {
-                                "url": url,
-                                "count": 1
-                            }
-                        }
-                    }
-                else:
-                    if tokens[token]["urls"].get(url, None) is None:
-                        tokens[token]["urls"][url] = {
-                            "url": url,
-                            "count": 1
-                        }
-                    else: tokens[token]["urls"][url]["count"] += 1
-
-            # Query the database to get all documents with token, and get their array elements that contain urls
-            unique_tokens = list(tokens.keys())
-            tokens_in_db = self.query_urls_in_tokens(unique_tokens, list(unique_urls))
-            # We take te db result and change it into a dictionary rather an array to easily search up stuff
-            tokens_in_db = {
-                doc["token"]: {
-                    "urls": [url_elem["url"] for url_elem in doc["urls"]]
-                } for doc in tokens_in_db
-            }
-            # Now we can begin to write stuff to database
+            for histogram in batch:
+                url = histogram["url"]
+                for token, count in histogram["tokens"].items():
+                    token_urls = tokens.setdefault(token, {})
+                    token_urls[url] = token_urls.get(url, 0) + count
+            # Urls crawled before have their old postings pulled out, so the new counts replace them instead of adding up
+            self.collection.bulk_write(
+                [self.pull_urls_update(token, list(token_urls)) for token, token_urls in tokens.items()], ordered=False
+            )
+            # Then push them to a bucket of the token that has room for them. If there isn't one, a new bucket is upserted
             tokens_to_write = []
-            for token in unique_tokens:
-                token_urls = list(tokens[token]["urls"].values())
-                # If the token does not exist in the database, add it as a new doc
-                if tokens_in_db.get(token, None) is None:
-                    if tokens_in_db.get(token, None) is None:
-                        tokens_to_write.append(UpdateOne(
-                            {"token": token},
-                            {"$push": {"urls": { "$each": token_urls }}},
-                            upsert=True
-                        ))
-                else:
-                    # If token does exist, check which urls exist in the doc array
-                    for url in [token_url["url"] for token_url in token_urls]:
-                        count = tokens[token]["urls"][url]["count"]
-                        # If url alreayd exists, simply increase its count by what we have
-                        if url in tokens_in_db[token]["urls"]:
-                            tokens_to_write.append(UpdateOne(
-                                {"token": token, "urls.url": url},
-                                {"$inc": {"urls.$.count": count}}
-                            ))
-                        else:
-                            # If url does not exist, push new element to array
-                            tokens_to_write.append(UpdateOne(
-                                {"token": token},
-                                {"$push": {"urls": {
-                                    "url": url,
-                                    "count": count
-                                }}}
-                            ))
+            for token, token_urls in tokens.items():
+                postings = sorted(
+                    [{"url": url, "count": count} for url, count in token_urls.items()],
+                    key=lambda posting: posting["count"], reverse=True
+                )
+                for i in range(0, len(postings), self.bucket_size):
+                    chunk = postings[i:i + self.bucket_size]
+                    tokens_to_write.append(UpdateOne(
+                        {"token": token, "size": {"$lte": self.bucket_size - len(chunk)}},
+                        {
+                            "$push": {"urls": {"$each": chunk, "$sort": {"count": -1}}},
+                            "$inc": {"size": len(chunk)},
+                            "$max": {"max_count": chunk[0]["count"]}
+                        },
+                        upsert=True
+                    ))
             self.collection.bulk_write(tokens_to_write, ordered=False)
-        except Exception as e: pass
-        self.buffer *= 0
+            self.bump_generation()
+        except Exception as e: self.write_errors += 1
 
 
 class ImageTokensDatabase(PageTokensDatabase):
-    def __init__(self, db_buffer_size=100, db_upload_delay=0):
-        super().__init__(db_buffer_size=db_buffer_size, db_upload_delay=db_upload_delay)
-        self.collection = os.getenv("MONGODB_IMAGE_TOKENS_COLLECTION", "image_tokens")
\ No newline at end of file
+    def __init__(self, db_buffer_size=100, db_upload_delay=0, bucket_size=1000, async_writes=False, write_queue_size=4):
+        super().__init__(
+            db_buffer_size=db_buffer_size, db_upload_delay=db_upload_delay, bucket_size=bucket_size,
+            async_writes=async_writes, write_queue_size=write_queue_size
+        )
+        self.collection = self.database[os.getenv("MONGODB_IMAGE_TOKENS_COLLECTION", "image_tokens")]
@@ -0,0 +1,202 @@
+"""Request metrics for the search server: per-stage timers and Mongo round trips of every request (sent back in a
+Server-Timing header), and counters and latency histograms for a Prometheus style /metrics page.
+
+There's no client library, just a few counters behind a lock, so collecting them costs next to nothing.
+Mongo round trips are counted with a pymongo command listener, which has to be registered (listen_to_mongo)
+before any client is made.
+"""
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from contextvars import ContextVar
+from pymongo import monitoring
+import bisect
+import threading
+import time
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def format_labels(labels: tuple, extra="") -> str:
+    parts = [f'{key}="{value}"' for key, value in labels]
+    if extra: parts.append(extra)
+    return "{" + ",".join(parts) + "}" if len(parts) > 0 else ""
+
+
+class Metric(ABC):
+    def __init__(self, name, help, type) -> None:
+        self.name = name
+        self.help = help
+        self.type = type
+        self.lock = threading.Lock()
+        # labels (sorted tuple of key, value pairs) -> value
+        self.series = {}
+
+    @abstractmethod
+    def lines(self) -> list:
+        """Sample lines of the metric, in the Prometheus text format"""
+
+    def render(self) -> str:
+        return "\n".join([f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"] + self.lines())
+
+
+class Counter(Metric):
+    def __init__(self, name, help) -> None:
+        super().__init__(name, help, "counter")
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.series[key] = self.series.get(key, 0) + amount
+
+    def lines(self) -> list:
+        with self.lock:
+            return [f"{self.name}{format_labels(labels)} {value}" for labels, value in self.series.items()]
+
+
+class Histogram(Metric):
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS) -> None:
+        super().__init__(name, help, "histogram")
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            if (series := self.series.get(key, None)) is None:
+                # count per bucket (last one is +Inf), sum, count
+                series = self.series[key] = [[0] * (len(self.buckets) + 1), 0, 0]
+            series[0][bisect.bisect_left(self.buckets, value)] += 1
+            series[1] += value
+            series[2] += 1
+
+    def lines(self) -> list:
+        lines = []
+        with self.lock:
+            for labels, (counts, total, count) in self.series.items():
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets + ("+Inf",), counts):
+                    cumulative += bucket_count
+                    bucket_labels = format_labels(labels, 'le="%s"' % bound)
+                    lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+                lines.append(f"{self.name}_sum{format_labels(labels)} {total}")
+                lines.append(f"{self.name}_count{format_labels(labels)} {count}")
+        return lines
+
+
+class Callback(Metric):
+    """Metric whose value is read when rendered (e.g. counters kept by someone else)"""
+    def __init__(self, name, help, type, read) -> None:
+        super().__init__(name, help, type)
+        self.read = read
+
+    def lines(self) -> list:
+        return [f"{self.name} {self.read()}"]
+
+
+class Registry:
+    def __init__(self) -> None:
+        self.metrics = []
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        return "\n".join(metric.render() for metric in self.metrics) + "\n"
+
+
+registry = Registry()
+request_seconds = registry.register(Histogram("search_request_seconds", "Time to handle a request, by endpoint"))
+stage_seconds = registry.register(Histogram("search_stage_seconds", "Time spent in each stage of a search"))
+request_round_trips = registry.register(Histogram(
+    "search_request_mongo_round_trips", "Mongo commands sent per request", (0, 1, 2, 3, 5, 8, 13, 21, 34, 55)
+))
+mongo_commands = registry.register(Counter("mongo_commands_total", "Mongo commands sent, by command"))
+mongo_command_seconds = registry.register(Histogram("mongo_command_seconds", "Mongo command round trip time, by command"))
+mongo_errors = registry.register(Counter("mongo_command_errors_total", "Mongo commands that failed, by command"))
+queries = registry.register(Counter("search_queries_total", "Searches, by whether they were ranked or served from cache"))
+
+
+class RequestTimer:
+    """Times the stages of one request, and counts its Mongo round trips"""
+    def __init__(self) -> None:
+        self.start = time.perf_counter()
+        self.stages = {}
+        self.round_trips = 0
+        self.db_seconds = 0
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try: yield
+        finally: self.add(name, time.perf_counter() - start)
+
+    def add(self, name, seconds):
+        self.stages[name] = self.stages.get(name, 0) + seconds
+
+    def elapsed(self):
+        return time.perf_counter() - self.start
+
+    def server_timing(self) -> str:
+        """Server-Timing header value, durations in ms"""
+        timings = [f"{name};dur={seconds * 1000:.2f}" for name, seconds in self.stages.items()]
+        timings.append(f'db;desc="{self.round_trips} round trips";dur={self.db_seconds * 1000:.2f}')
+        timings.append(f"total;dur={self.elapsed() * 1000:.2f}")
+        return ", ".join(timings)
+
+    def observe(self, endpoint):
+        """Adds the request to the histograms"""
+        request_seconds.observe(self.elapsed(), endpoint=endpoint)
+        request_round_trips.observe(self.round_trips, endpoint=endpoint)
+        for name, seconds in self.stages.items():
+            stage_seconds.observe(seconds, stage=name)
+
+
+# timer of the request being handled (each request has its own thread, or its own task if async)
+current_timer = ContextVar("current_timer", default=None)
+
+
+class TimedIndex:
+    """Wraps a search index, so the time top_k spends getting token stats and postings shows up as stages"""
+    def __init__(self, index, timer: RequestTimer) -> None:
+        self.index = index
+        self.timer = timer
+        # top_k only asks for postings in batches if the index can
+        if hasattr(index, "get_postings_batch"): self.get_postings_batch = self.get_timed_postings_batch
+
+    def get_token_stats(self, tokens):
+        with self.timer.stage("token_stats"):
+            return self.index.get_token_stats(tokens)
+
+    def get_token_postings(self, token, min_count=0, urls=[]):
+        with self.timer.stage("postings"):
+            return self.index.get_token_postings(token, min_count, urls)
+
+    def get_top_postings(self, token, k=50):
+        with self.timer.stage("postings"):
+            return self.index.get_top_postings(token, k)
+
+    def get_timed_postings_batch(self, requests):
+        with self.timer.stage("postings"):
+            return self.index.get_postings_batch(requests)
+
+
+class CommandTimer(monitoring.CommandListener):
+    def started(self, event):
+        if (timer := current_timer.get()) is not None:
+            timer.round_trips += 1
+
+    def succeeded(self, event):
+        seconds = event.duration_micros / 1000000
+        mongo_commands.inc(command=event.command_name)
+        mongo_command_seconds.observe(seconds, command=event.command_name)
+        if (timer := current_timer.get()) is not None:
+            timer.db_seconds += seconds
+
+    def failed(self, event):
+        mongo_commands.inc(command=event.command_name)
+        mongo_errors.inc(command=event.command_name)
+
+
+def listen_to_mongo():
+    """Counts Mongo commands of every client made after this"""
+    monitoring.register(CommandTimer())
@@ -0,0 +1,57 @@
+"""Rewrites a token collection into sorted, bounded-size buckets
+
+Works on the old layout (one doc per token with every url in it) and on already bucketed collections,
+where it drops duplicate urls and re-sorts the buckets by count (crawling only appends to the last buckets,
+so running this once in a while keeps the best postings in the first buckets).
+
+The new buckets are written to a temporary collection, which then replaces the original one.
+Usage (from the web directory): python migrate_tokens.py [--images] [--bucket-size 1000]
+"""
+import argparse
+from pymongo import ASCENDING
+from database import PageTokensDatabase, ImageTokensDatabase
+
+
+def migrate(tokens_db: PageTokensDatabase, bucket_size=1000, batch_size=1000):
+    source = tokens_db.collection
+    target = tokens_db.database[source.name + "_migrating"]
+    target.drop()
+    PageTokensDatabase.create_indexes(target)
+
+    buckets = []
+    total_tokens = 0
+    def write_token(token, urls):
+        nonlocal total_tokens
+        postings = [{"url": url, "count": count} for url, count in urls.items()]
+        buckets.extend(PageTokensDatabase.make_buckets(token, postings, bucket_size))
+        total_tokens += 1
+        if len(buckets) >= batch_size:
+            target.insert_many(buckets, ordered=True)
+            buckets.clear()
+
+    # all buckets of a token come one after another when sorted by token, so we only hold one token in memory
+    token, urls = None, {}
+    for doc in source.find({}, {"_id": 0, "token": 1, "urls": 1}, sort=[("token", ASCENDING)], no_cursor_timeout=True):
+        if doc["token"] != token:
+            if token is not None: write_token(token, urls)
+            token, urls = doc["token"], {}
+        # a url is only in one bucket of a token (collections written before recrawls replaced postings
+        # can have it twice, then one of them is kept)
+        for url_elem in doc.get("urls", []):
+            urls[url_elem["url"]] = url_elem["count"]
+    if token is not None: write_token(token, urls)
+    if len(buckets) > 0: target.insert_many(buckets, ordered=True)
+
+    target.rename(source.name, dropTarget=True)
+    tokens_db.bump_generation()
+    print ("- Migrated", total_tokens, "tokens into", source.name)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rewrite token collection into sorted buckets")
+    parser.add_argument("--images", action="store_true", help="migrate image tokens instead of page tokens")
+    parser.add_argument("--bucket-size", type=int, default=1000, help="max urls per bucket doc")
+    args = parser.parse_args()
+    tokens_db = ImageTokensDatabase() if args.images else PageTokensDatabase()
+    migrate(tokens_db, bucket_size=args.bucket_size)
+    tokens_db.close_connection()
@@ -0,0 +1,98 @@
+"""Offline PageRank over the link graph in the pages collection
+
+Reads the forward links (`urls`) of every page, runs PageRank with NumPy, and writes a `rank` score on every page.
+Ranks are scaled so the average page has rank 1. The search server uses them to boost pages with many good backlinks.
+
+The graph is kept in CSR form: page ids are the pages in _id order, the link targets of all pages are in one
+int32 array, and page i's targets are `targets[offsets[i]:offsets[i + 1]]`. Links to urls that aren't in the
+pages collection are dropped.
+
+Usage (from the web directory): python pagerank.py [--damping 0.85] [--iterations 100] [--tolerance 1e-6]
+"""
+import argparse
+import numpy as np
+from pymongo import ASCENDING, UpdateOne
+from database import PagesDatabase
+
+# links are collected in numpy chunks of this size, rather than python lists of ints
+CHUNK_SIZE = 1000000
+
+
+def load_graph(pages_db: PagesDatabase):
+    """Returns (urls, offsets, targets). Streams the pages twice (ordered by _id both times): once for ids, once for links"""
+    urls = [doc["url"] for doc in pages_db.collection.find({}, {"_id": 0, "url": 1}, sort=[("_id", ASCENDING)], batch_size=10000)]
+    ids = {url: i for i, url in enumerate(urls)}
+
+    out_degrees = np.zeros(len(urls), dtype=np.int64)
+    chunks = []
+    chunk = np.empty(CHUNK_SIZE, dtype=np.int32)
+    filled = 0
+    for doc in pages_db.collection.find({}, {"_id": 0, "url": 1, "urls": 1}, sort=[("_id", ASCENDING)], batch_size=1000):
+        # pages added since the first pass aren't in the graph
+        if (source := ids.get(doc["url"], None)) is None: continue
+        for url in set(doc.get("urls", None) or []):
+            if (target := ids.get(url, None)) is None or target == source: continue
+            chunk[filled] = target
+            filled += 1
+            out_degrees[source] += 1
+            if filled == CHUNK_SIZE:
+                chunks.append(chunk)
+                chunk = np.empty(CHUNK_SIZE, dtype=np.int32)
+                filled = 0
+    chunks.append(chunk[:filled])
+    targets = np.concatenate(chunks)
+    offsets = np.zeros(len(urls) + 1, dtype=np.int64)
+    np.cumsum(out_degrees, out=offsets[1:])
+    return urls, offsets, targets
+
+
+def pagerank(offsets, targets, damping=0.85, iterations=100, tolerance=1e-6):
+    """Power iteration. Rank of pages without links (dangling) is spread evenly over all pages.
+    Returns array of ranks that add up to 1
+    """
+    total = len(offsets) - 1
+    if total == 0: return np.zeros(0)
+    out_degrees = np.diff(offsets)
+    dangling = out_degrees == 0
+    ranks = np.full(total, 1 / total)
+    done = 0
+    for _ in range(iterations):
+        # every page gives its rank evenly to the pages it links to
+        shares = np.zeros(total)
+        np.divide(ranks, out_degrees, out=shares, where=~dangling)
+        new_ranks = np.bincount(targets, weights=np.repeat(shares, out_degrees), minlength=total)
+        new_ranks = damping * (new_ranks + ranks[dangling].sum() / total) + (1 - damping) / total
+        change = np.abs(new_ranks - ranks).sum()
+        ranks = new_ranks
+        done += 1
+        if change < tolerance: break
+    print ("- PageRank done after", done, "iterations")
+    return ranks
+
+
+def write_ranks(pages_db: PagesDatabase, urls: list, ranks, batch_size=1000):
+    # scale so that the average page has rank 1, it's easier to reason about than tiny fractions
+    ranks = ranks * len(urls)
+    updates = []
+    for url, rank in zip(urls, ranks.tolist()):
+        updates.append(UpdateOne({"_id": url}, {"$set": {"rank": rank}}))
+        if len(updates) >= batch_size:
+            pages_db.collection.bulk_write(updates, ordered=False)
+            updates = []
+    if len(updates) > 0: pages_db.collection.bulk_write(updates, ordered=False)
+    # cached results were ordered with the old ranks
+    pages_db.bump_generation()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compute PageRank of pages and save it as their rank")
+    parser.add_argument("--damping", type=float, default=0.85)
+    parser.add_argument("--iterations", type=int, default=100, help="max power iterations")
+    parser.add_argument("--tolerance", type=float, default=1e-6, help="stop once ranks change less than this (L1)")
+    args = parser.parse_args()
+    pages_db = PagesDatabase()
+    urls, offsets, targets = load_graph(pages_db)
+    print ("- Loaded", len(urls), "pages and", len(targets), "links")
+    ranks = pagerank(offsets, targets, args.damping, args.iterations, args.tolerance)
+    write_ranks(pages_db, urls, ranks)
+    pages_db.close_connection()
@@ -0,0 +1,178 @@
+import asyncio
+import heapq
+import inspect
+import math
+
+
+def idf(df: int, total_docs: int) -> float:
+    """Inverse document frequency of a token. Rare tokens weigh more than common ones"""
+    return math.log(1 + max(total_docs, df) / df)
+
+
+def maxscore_rounds(tokens: list, stats: dict, k=50, total_docs=0, on_candidates=None):
+    """The k best (url, score) pairs for the tokens, sorted by score, found in at most three rounds of postings fetches.
+    A url's score is the sum of count * idf of every token it has.
+
+    1. The best postings of the rarest token, read from its highest counts down until the k best are known
+       (see PageTokensDatabase.get_top_postings). The k-th best score they give is a lower bound of the final
+       k-th best score. For a one token query, that's already the top k
+    2. Every token at once. Each only returns postings worth at least its share of that threshold (shares are
+       split by max score and add up to the threshold), so any url that can make the top k is in at least one of them.
+       The rarest token is only asked again if its share goes below what round 1 read
+    3. Urls that can still make it get the counts they're missing filled in, again every token at once
+
+    This is a generator: it first yields the rarest token, and has to be sent back `index.get_top_postings(token, k)`.
+    Then it yields each round as a dict of token -> (min_count, urls), and has to be sent back the postings of each
+    token (dict of token -> postings), like `index.get_token_postings(token, min_count, urls)` would return them.
+    top_k and async_top_k do the fetching, so the number of round trips doesn't grow with the number of tokens.
+    Returns (through StopIteration) the results
+    """
+    tokens = [token for token in tokens if stats.get(token, {}).get("df", 0) > 0]
+    if len(tokens) == 0: return []
+    # rarest token first, since it has the highest weight and the shortest postings
+    tokens.sort(key=lambda token: stats[token]["df"])
+    weights = {token: idf(stats[token]["df"], total_docs) for token in tokens}
+    max_scores = {token: stats[token]["max_count"] * weights[token] for token in tokens}
+
+    first = tokens[0]
+    # postings of first we didn't get have a count of at most bound
+    top, bound = yield first
+    scores = {url: count * weights[first] for url, count in top.items()}
+    if len(tokens) == 1: return heapq.nlargest(k, scores.items(), key=lambda scored_url: scored_url[1])
+    threshold = heapq.nlargest(k, scores.values())[-1] if len(scores) >= k else 0
+    total_max_score = sum(max_scores.values())
+    min_counts = {token: threshold * stats[token]["max_count"] / total_max_score for token in tokens}
+
+    requests = {token: (min_counts[token], []) for token in tokens[1:]}
+    if 0 < min_counts[first] <= bound: requests[first] = (min_counts[first], [])
+    seen = yield requests
+    for token, postings in seen.items():
+        for url, count in postings.items():
+            if token == first and url in top: continue
+            scores[url] = scores.get(url, 0) + count * weights[token]
+    seen[first] = {**seen.get(first, {}), **top}
+
+    # a token's count of a url we didn't get back is under its min count (min count 0 means we got all of them),
+    # or for the rarest token, at most bound if it wasn't asked again
+    limits = {token: min_counts[token] for token in tokens[1:] if min_counts[token] > 0}
+    if bound > 0: limits[first] = min_counts[first] if first in requests else bound
+    missing_tokens = list(limits)
+    def best_possible(url):
+        return scores[url] + sum(limits[token] * weights[token] for token in missing_tokens if url not in seen[token])
+    threshold = heapq.nlargest(k, scores.values())[-1] if len(scores) >= k else 0
+    candidates = [url for url in scores if best_possible(url) >= threshold]
+    if on_candidates is not None: on_candidates(candidates)
+
+    missing = {token: [url for url in candidates if url not in seen[token]] for token in missing_tokens}
+    # a min count over max_count gets only the urls asked for
+    missing = {token: (stats[token]["max_count"] + 1, urls) for token, urls in missing.items() if len(urls) > 0}
+    filled = (yield missing) if len(missing) > 0 else {}
+    for token, postings in filled.items():
+        for url, count in postings.items():
+            scores[url] += count * weights[token]
+    return heapq.nlargest(k, ((url, scores[url]) for url in candidates), key=lambda scored_url: scored_url[1])
+
+
+def top_k(index, tokens: list, k=50, total_docs=0) -> list:
+    """Returns the k best (url, score) pairs for the tokens, sorted by score
+
+    A url's score is the sum of count * idf of every token it has. Indexes that can get the postings of many tokens
+    in one go (like PageTokensDatabase, in one aggregation) are asked in the rounds of maxscore_rounds, so a query
+    takes one round trip for the token stats and at most three for postings however many tokens it has.
+
+    Other indexes (like IndexSegment, where a lookup doesn't cost a round trip) are asked token by token, from
+    rarest to most common, keeping the best scores seen so far. Once we have k urls, any new url has to beat the k-th
+    best score with what the remaining tokens can give it at most (their max_count * idf), so we only ask
+    the index for postings that are big enough, plus the urls we already have. This prunes more than the rounds,
+    since the threshold goes up after every token.
+
+    Either way, only the best postings of the rarest token are read to start with (from its highest counts down,
+    until the k best are known), so a one token query never reads a whole posting list.
+
+    :param index: where postings come from. Needs `get_token_stats(tokens)`, `get_top_postings(token, k)` and
+        `get_token_postings(token, min_count, urls)`, and `get_postings_batch(requests)` to be asked in rounds
+    :param total_docs: number of documents in the collection (used for idf)
+    """
+    tokens = list(dict.fromkeys(tokens))
+    if len(tokens) == 0 or k <= 0: return []
+    stats = index.get_token_stats(tokens)
+    if hasattr(index, "get_postings_batch"):
+        rounds = maxscore_rounds(tokens, stats, k, total_docs)
+        try:
+            first = next(rounds)
+            requests = rounds.send(index.get_top_postings(first, k))
+            while True: requests = rounds.send(index.get_postings_batch(requests))
+        except StopIteration as done: return done.value
+
+    tokens = [token for token in tokens if stats.get(token, {}).get("df", 0) > 0]
+    # rarest tokens first, since they have the highest weights and the shortest postings
+    tokens.sort(key=lambda token: stats[token]["df"])
+    weights = {token: idf(stats[token]["df"], total_docs) for token in tokens}
+    max_scores = {token: stats[token]["max_count"] * weights[token] for token in tokens}
+
+    if len(tokens) == 0: return []
+    # the rarest token's best postings, read from its highest counts down. Urls that weren't read can still
+    # get up to `unseen` from it, and get their count filled in at the end
+    first = tokens[0]
+    top, bound = index.get_top_postings(first, k)
+    scores = {url: count * weights[first] for url, count in top.items()}
+    unseen = bound * weights[first]
+    remaining = sum(max_scores.values()) - max_scores[first]
+    for token in tokens[1:]:
+        remaining -= max_scores[token]
+        threshold = heapq.nlargest(k, scores.values())[-1] if len(scores) >= k else 0
+        if threshold > 0:
+            # urls that can't reach the k-th best score anymore are dropped
+            scores = {
+                url: score for url, score in scores.items()
+                if score + max_scores[token] + remaining + (unseen if url not in top else 0) >= threshold
+            }
+            # new urls need at least this much count in this token to be able to make it
+            min_count = (threshold - remaining - unseen) / weights[token]
+        else: min_count = 0
+        if min_count > stats[token]["max_count"] and len(scores) == 0: continue
+        postings = index.get_token_postings(token, min_count, list(scores.keys()) if min_count > 0 else [])
+        for url, count in postings.items():
+            if url in scores: scores[url] += count * weights[token]
+            elif count >= min_count: scores[url] = count * weights[token]
+    if bound > 0 and len(missing := [url for url in scores if url not in top]) > 0:
+        # a min count over max_count gets only the urls asked for
+        for url, count in index.get_token_postings(first, stats[first]["max_count"] + 1, missing).items():
+            scores[url] += count * weights[first]
+    return heapq.nlargest(k, scores.items(), key=lambda scored_url: scored_url[1])
+
+
+async def resolve(value):
+    """Awaits value if it needs to be, so async_top_k works with async indexes and plain ones (like IndexSegment)"""
+    return await value if inspect.isawaitable(value) else value
+
+
+async def async_top_k(index, tokens: list, k=50, total_docs=0, on_candidates=None) -> list:
+    """Same as top_k, but the postings of all tokens of a round are fetched at the same time
+
+    :param on_candidates: called with the urls that can still make the top k before the last round starts,
+        so callers can start fetching those pages while the scores are being finished
+    """
+    tokens = list(dict.fromkeys(tokens))
+    if len(tokens) == 0 or k <= 0: return []
+    rounds = maxscore_rounds(tokens, await resolve(index.get_token_stats(tokens)), k, total_docs, on_candidates)
+    try:
+        first = next(rounds)
+        requests = rounds.send(await resolve(index.get_top_postings(first, k)))
+        while True:
+            postings = await asyncio.gather(*[
+                resolve(index.get_token_postings(token, min_count, urls)) for token, (min_count, urls) in requests.items()
+            ])
+            requests = rounds.send(dict(zip(requests, postings)))
+    except StopIteration as done: return done.value
+
+
+def boost_by_rank(scored_urls: list, ranks: dict, weight=0.5) -> list:
+    """Returns urls of (url, score) pairs, ordered by score * (1 + weight * log(1 + rank)).
+    Ranks come from pagerank.py (average page has rank 1). Urls without a rank aren't boosted
+    """
+    def boosted(scored_url):
+        url, score = scored_url
+        rank = ranks.get(url, None) or 0
+        return score * (1 + weight * math.log1p(rank))
+    return [url for url, score in sorted(scored_urls, key=boosted, reverse=True)]
@@ -0,0 +1,272 @@
+"""Immutable on-disk index segments, read with mmap
+
+A segment is a single file exported from the token and pages collections. Search workers map it read only,
+so every worker process shares the same copy from the OS page cache, and opening it costs nothing.
+Mongo stays the source of truth, re-export the segment to pick up new crawls.
+
+File layout (little endian):
+    header:     magic, version, num_terms, num_docs, then offsets of the sections below
+    postings:   for each term, its block table, then its blocks. Postings are split in blocks of BLOCK_SIZE,
+                doc ids ascending. A block is (doc id delta, count) pairs as varints, and its entry in the
+                block table is (last doc id, max count, length), so readers only decode blocks that can have
+                postings they want (see IndexSegment.get_token_postings)
+    terms:      term entries (postings offset, postings length, df, max_count), sorted by term
+    term blob:  offsets into the utf-8 term strings
+    doc table:  offsets into the utf-8 urls. Doc ids are the urls in sorted order, so urls can be binary searched
+
+Usage (from the web directory): python segment.py index.seg [--images]
+"""
+import argparse
+import bisect
+import mmap
+import os
+import struct
+
+MAGIC = b"VSEG"
+VERSION = 1
+HEADER = struct.Struct("<4sIII5Q")
+TERM_ENTRY = struct.Struct("<QQII")
+BLOCK_ENTRY = struct.Struct("<III")
+BLOCK_SIZE = 128
+# how many urls IndexSegment remembers the doc ids of
+DOC_ID_CACHE_SIZE = 100000
+OFFSET = struct.Struct("<Q")
+
+
+def encode_varint(value: int, out: bytearray):
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def decode_varints(data) -> list:
+    values = []
+    value = shift = 0
+    for byte in data:
+        value |= (byte & 0x7F) << shift
+        if byte & 0x80: shift += 7
+        else:
+            values.append(value)
+            value = shift = 0
+    return values
+
+
+class SegmentWriter:
+    """Writes a segment file. Postings are streamed to disk as terms are added, in any order
+
+    :param path: where to write the segment. It's written to a temp file and moved in place on close,
+        so workers that have the old segment mapped keep reading it
+    :param urls: every url that postings can refer to
+    """
+
+    def __init__(self, path: str, urls) -> None:
+        self.path = path
+        self.urls = sorted(set(urls))
+        self.doc_ids = {url: doc_id for doc_id, url in enumerate(self.urls)}
+        self.file = open(path + ".tmp", "wb")
+        self.file.write(b"\0" * HEADER.size)
+        self.terms = []
+        self.skipped = 0
+
+    def add_term(self, term: str, postings: dict):
+        """Adds a term with its postings (dict of url -> count). Urls that are not in the doc table are skipped"""
+        doc_counts = []
+        for url, count in postings.items():
+            if (doc_id := self.doc_ids.get(url, None)) is None:
+                self.skipped += 1
+                continue
+            doc_counts.append((doc_id, count))
+        if len(doc_counts) == 0: return
+        doc_counts.sort()
+        table = bytearray()
+        data = bytearray()
+        last = 0
+        for i in range(0, len(doc_counts), BLOCK_SIZE):
+            block = doc_counts[i:i + BLOCK_SIZE]
+            start = len(data)
+            # deltas carry on from the last doc of the previous block
+            for doc_id, count in block:
+                encode_varint(doc_id - last, data)
+                encode_varint(count, data)
+                last = doc_id
+            table += BLOCK_ENTRY.pack(last, max(count for _, count in block), len(data) - start)
+        self.terms.append((
+            term.encode("utf-8"), self.file.tell(), len(table) + len(data), len(doc_counts), max(count for _, count in doc_counts)
+        ))
+        self.file.write(table)
+        self.file.write(data)
+
+    def _write_strings(self, strings: list):
+        """Writes offsets table followed by the strings, returns (offsets position, blob position)"""
+        offsets_pos = self.file.tell()
+        offset = 0
+        for string in strings:
+            self.file.write(OFFSET.pack(offset))
+            offset += len(string)
+        self.file.write(OFFSET.pack(offset))
+        blob_pos = self.file.tell()
+        for string in strings:
+            self.file.write(string)
+        return offsets_pos, blob_pos
+
+    def close(self):
+        self.terms.sort()
+        terms_pos = self.file.tell()
+        for _, postings_pos, postings_len, df, max_count in self.terms:
+            self.file.write(TERM_ENTRY.pack(postings_pos, postings_len, df, max_count))
+        term_offsets_pos, term_blob_pos = self._write_strings([term[0] for term in self.terms])
+        doc_offsets_pos, doc_blob_pos = self._write_strings([url.encode("utf-8") for url in self.urls])
+        self.file.seek(0)
+        self.file.write(HEADER.pack(
+            MAGIC, VERSION, len(self.terms), len(self.urls),
+            terms_pos, term_offsets_pos, term_blob_pos, doc_offsets_pos, doc_blob_pos
+        ))
+        self.file.close()
+        os.replace(self.path + ".tmp", self.path)
+
+
+class IndexSegment:
+    """Read only view of a segment file. Has the same search functions as PageTokensDatabase, so it can be used by `search.top_k`"""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        with open(path, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.num_terms, self.num_docs, self.terms_pos, self.term_offsets_pos, self.term_blob_pos, \
+            self.doc_offsets_pos, self.doc_blob_pos = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a version {VERSION} index segment")
+        # urls handed out recently -> doc id. top_k asks for postings of the urls it got before,
+        # so they're found without binary searching the doc table again
+        self.recent_doc_ids = {}
+
+    def _string(self, offsets_pos: int, blob_pos: int, i: int) -> bytes:
+        start, end = struct.unpack_from("<QQ", self.mm, offsets_pos + i * OFFSET.size)
+        return self.mm[blob_pos + start:blob_pos + end]
+
+    def _search(self, offsets_pos: int, blob_pos: int, total: int, key: bytes):
+        """Binary search sorted strings, returns index of key or None"""
+        low, high = 0, total - 1
+        while low <= high:
+            mid = (low + high) // 2
+            value = self._string(offsets_pos, blob_pos, mid)
+            if value == key: return mid
+            elif value < key: low = mid + 1
+            else: high = mid - 1
+        return None
+
+    def _term_entry(self, term: str):
+        i = self._search(self.term_offsets_pos, self.term_blob_pos, self.num_terms, term.encode("utf-8"))
+        if i is None: return None
+        return TERM_ENTRY.unpack_from(self.mm, self.terms_pos + i * TERM_ENTRY.size)
+
+    def get_url(self, doc_id: int) -> str:
+        url = self._string(self.doc_offsets_pos, self.doc_blob_pos, doc_id).decode("utf-8")
+        if len(self.recent_doc_ids) >= DOC_ID_CACHE_SIZE: self.recent_doc_ids.clear()
+        self.recent_doc_ids[url] = doc_id
+        return url
+
+    def get_doc_id(self, url: str):
+        if (doc_id := self.recent_doc_ids.get(url, None)) is not None: return doc_id
+        return self._search(self.doc_offsets_pos, self.doc_blob_pos, self.num_docs, url.encode("utf-8"))
+
+    def get_token_stats(self, tokens: list) -> dict:
+        """Returns dict of token -> {"df": number of urls with token, "max_count": highest count of token in a url}"""
+        stats = {}
+        for token in tokens:
+            if (entry := self._term_entry(token)) is not None:
+                stats[token] = {"df": entry[2], "max_count": entry[3]}
+        return stats
+
+    def get_token_postings(self, token: str, min_count=0, urls=[]) -> dict:
+        """Returns dict of url -> count for a token. Only urls with at least min_count, or urls in `urls` are returned.
+        Blocks whose max count is under min_count, and that can't have any of the urls, aren't decoded
+        """
+        if (entry := self._term_entry(token)) is None: return {}
+        postings_pos, _, df, max_count = entry
+        doc_ids = set(doc_id for url in urls if (doc_id := self.get_doc_id(url)) is not None)
+        if min_count > max_count and len(doc_ids) == 0: return {}
+        sorted_doc_ids = sorted(doc_ids)
+        num_blocks = (df + BLOCK_SIZE - 1) // BLOCK_SIZE
+        data_pos = postings_pos + num_blocks * BLOCK_ENTRY.size
+        postings = {}
+        # last doc id of the previous block, doc ids of a block are after it
+        previous = 0
+        for i, (last, block_max, length) in enumerate(BLOCK_ENTRY.iter_unpack(self.mm[postings_pos:data_pos])):
+            first = previous + 1 if i > 0 else 0
+            has_urls = bisect.bisect_left(sorted_doc_ids, first) < bisect.bisect_right(sorted_doc_ids, last)
+            if block_max >= min_count or has_urls:
+                values = decode_varints(self.mm[data_pos:data_pos + length])
+                doc_id = previous
+                for j in range(0, len(values), 2):
+                    doc_id += values[j]
+                    if values[j + 1] >= min_count or (has_urls and doc_id in doc_ids):
+                        postings[self.get_url(doc_id)] = values[j + 1]
+            data_pos += length
+            previous = last
+        return postings
+
+    def get_top_postings(self, token: str, k=50) -> tuple:
+        """Decodes a token's blocks from the highest max count down, until the k best postings are known.
+        Returns (postings, bound) like PageTokensDatabase.get_top_postings
+        """
+        from database import TopPostings
+        if (entry := self._term_entry(token)) is None: return {}, 0
+        postings_pos, _, df, _ = entry
+        num_blocks = (df + BLOCK_SIZE - 1) // BLOCK_SIZE
+        data_pos = postings_pos + num_blocks * BLOCK_ENTRY.size
+        # (max count, data position, length, last doc id of the previous block) of each block
+        blocks = []
+        previous = 0
+        for last, block_max, length in BLOCK_ENTRY.iter_unpack(self.mm[postings_pos:data_pos]):
+            blocks.append((block_max, data_pos, length, previous))
+            data_pos += length
+            previous = last
+        blocks.sort(key=lambda block: block[0], reverse=True)
+        top = TopPostings(k)
+        for block_max, data_pos, length, previous in blocks:
+            if top.done(block_max): break
+            values = decode_varints(self.mm[data_pos:data_pos + length])
+            doc_id = previous
+            for j in range(0, len(values), 2):
+                doc_id += values[j]
+                top.add(self.get_url(doc_id), values[j + 1])
+        return top.postings, top.bound
+
+    def close(self):
+        self.mm.close()
+
+
+def export_segment(path: str, pages_db, tokens_db):
+    """Builds a segment from the pages and token collections"""
+    from pymongo import ASCENDING
+    urls = (doc["url"] for doc in pages_db.collection.find({}, {"_id": 0, "url": 1}))
+    writer = SegmentWriter(path, urls)
+    # buckets of a token come one after another when sorted by token
+    token, postings = None, {}
+    for doc in tokens_db.collection.find({}, {"_id": 0, "token": 1, "urls": 1}, sort=[("token", ASCENDING)], no_cursor_timeout=True):
+        if doc["token"] != token:
+            if token is not None: writer.add_term(token, postings)
+            token, postings = doc["token"], {}
+        # a url is only in one bucket of a token (collections written before recrawls replaced postings
+        # can have it twice, then one of them is kept)
+        for url_elem in doc.get("urls", []):
+            postings[url_elem["url"]] = url_elem["count"]
+    if token is not None: writer.add_term(token, postings)
+    writer.close()
+    print ("- Exported", len(writer.terms), "terms and", len(writer.urls), "urls to", path)
+    if writer.skipped > 0: print ("-  ", writer.skipped, "postings skipped because their url is not in pages")
+
+
+if __name__ == "__main__":
+    from database import PagesDatabase, ImageDatabase, PageTokensDatabase, ImageTokensDatabase
+    parser = argparse.ArgumentParser(description="Export token collection into an index segment file")
+    parser.add_argument("path", help="where to write the segment")
+    parser.add_argument("--images", action="store_true", help="export image tokens instead of page tokens")
+    args = parser.parse_args()
+    pages_db = ImageDatabase() if args.images else PagesDatabase()
+    tokens_db = ImageTokensDatabase() if args.images else PageTokensDatabase()
+    export_segment(args.path, pages_db, tokens_db)
+    pages_db.close_connection()
+    tokens_db.close_connection()
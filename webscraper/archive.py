@@ -0,0 +1,200 @@
+"""Append-only archive of the raw html of crawled pages, so pages can be parsed and indexed again without recrawling
+
+An archive is a directory of segment files (pages-00000.warc.gz, pages-00001.warc.gz, ...) and an index.
+Every record is its own gzip member with WARC-like headers, so segments can be read with `zcat` and a single record
+can be decompressed on its own. A new segment is started when the current one gets over the segment size.
+The index (index.tsv) has a line per record: url, segment number, offset and length (compressed) of the record.
+A record is flushed to its segment before its index line is written, and the index is flushed every `flush_every`
+records, so if the crawler is killed the index can only be behind the segments, never point past them.
+
+To parse an archive again and write the results to the database (from the project root):
+    python -m webscraper.archive <archive_dir> [--processes 4]
+"""
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+from scrapy.http import HtmlResponse
+from webscraper.parser import parse_document, parse_tree
+from webscraper.scrape import get_urls
+import argparse
+import gzip
+import io
+import multiprocessing
+import os
+import re
+
+SEGMENT_PATTERN = re.compile(r"^pages-(\d+)\.warc\.gz$")
+
+
+def segment_path(directory, number):
+    return os.path.join(directory, f"pages-{number:05d}.warc.gz")
+
+def index_path(directory):
+    return os.path.join(directory, "index.tsv")
+
+def list_segments(directory):
+    """Returns segment numbers in the archive, in order"""
+    numbers = []
+    for name in os.listdir(directory):
+        if match := SEGMENT_PATTERN.match(name): numbers.append(int(match.group(1)))
+    return sorted(numbers)
+
+
+class ArchiveWriter:
+    """Appends pages to an archive. Opening an existing archive keeps appending to its last segment"""
+
+    def __init__(self, directory, segment_size=1 << 30, compress_level=6, flush_every=100) -> None:
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.segment_size = segment_size
+        self.compress_level = compress_level
+        self.flush_every = flush_every
+        segments = list_segments(directory)
+        self.segment = segments[-1] if len(segments) > 0 else 0
+        self.file = open(segment_path(directory, self.segment), "ab")
+        self.index = open(index_path(directory), "a")
+        self.count = 0
+
+    def write(self, url: str, text: str, date=None):
+        body = text.encode("utf-8")
+        date = date or datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
+        headers = (
+            "WARC/1.0\r\n"
+            "WARC-Type: response\r\n"
+            f"WARC-Target-URI: {url}\r\n"
+            f"WARC-Date: {date}\r\n"
+            "Content-Type: text/html; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "\r\n"
+        ).encode("utf-8")
+        record = gzip.compress(headers + body + b"\r\n\r\n", self.compress_level)
+        if self.file.tell() > 0 and self.file.tell() + len(record) > self.segment_size:
+            self.rotate()
+        offset = self.file.tell()
+        self.file.write(record)
+        # the record has to be in the segment before the index points at it
+        self.file.flush()
+        self.index.write(f"{url}\t{self.segment}\t{offset}\t{len(record)}\n")
+        self.count += 1
+        if self.count % self.flush_every == 0: self.index.flush()
+
+    def rotate(self):
+        self.file.close()
+        self.segment += 1
+        self.file = open(segment_path(self.directory, self.segment), "ab")
+
+    def close(self):
+        self.file.close()
+        self.index.close()
+
+
+class ArchiveRecord:
+    def __init__(self, url, date, body: bytes) -> None:
+        self.url = url
+        self.date = date
+        self.body = body
+
+    @property
+    def text(self):
+        return self.body.decode("utf-8", errors="replace")
+
+
+def read_record(f):
+    """Reads the next record from an (uncompressed) stream, or returns None at the end"""
+    line = f.readline()
+    # skip anything left of a record that was cut off
+    while line and not line.startswith(b"WARC/"):
+        line = f.readline()
+    if not line: return None
+    headers = {}
+    while (line := f.readline().rstrip(b"\r\n")):
+        key, value = line.decode("utf-8").split(":", 1)
+        headers[key] = value.strip()
+    body = f.read(int(headers.get("Content-Length", 0)))
+    f.read(4)
+    return ArchiveRecord(headers.get("WARC-Target-URI", None), headers.get("WARC-Date", None), body)
+
+
+class ArchiveReader:
+    """Reads pages back from an archive, either all of them in order or one by url (using the index)"""
+
+    def __init__(self, directory) -> None:
+        self.directory = directory
+        self.offsets = None
+
+    def __iter__(self):
+        for number in list_segments(self.directory):
+            # gzip reads through all the members of a file as one stream
+            with gzip.open(segment_path(self.directory, number), "rb") as f:
+                try:
+                    while (record := read_record(f)) is not None:
+                        yield record
+                except (EOFError, gzip.BadGzipFile):
+                    # last record was cut off (crawler was killed while writing it)
+                    pass
+
+    def load_index(self):
+        self.offsets = {}
+        with open(index_path(self.directory)) as f:
+            for line in f:
+                # a last line without a newline was cut off
+                if not line.endswith("\n"): break
+                url, segment, offset, length = line.rstrip("\n").rsplit("\t", 3)
+                # later copies of a page replace earlier ones
+                self.offsets[url] = (int(segment), int(offset), int(length))
+
+    def get(self, url):
+        """Returns the latest record of url, or None if it isn't archived"""
+        if self.offsets is None: self.load_index()
+        if (location := self.offsets.get(url, None)) is None: return None
+        segment, offset, length = location
+        with open(segment_path(self.directory, segment), "rb") as f:
+            f.seek(offset)
+            try: data = gzip.decompress(f.read(length))
+            # the record was cut off
+            except (EOFError, gzip.BadGzipFile): return None
+        return read_record(io.BytesIO(data))
+
+
+def parse_record(url, text):
+    """Parses an archived page like the spider and ParserPipeline would. Returns (urls, parsed), or None"""
+    if (doc := parse_document(text)) is None: return None
+    response = HtmlResponse(url, body=text.encode("utf-8"), encoding="utf-8")
+    # urls first, since parse_tree changes the tree
+    urls = get_urls(response, doc)
+    return urls, parse_tree(doc)
+
+
+def reprocess(directory, processes=None, batch_size=256):
+    """Streams (url, urls, parsed) for every page in the archive, parsed in a pool of processes"""
+    reader = iter(ArchiveReader(directory))
+    with ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context("spawn")) as pool:
+        while True:
+            # in batches, so the whole archive isn't read in at once
+            batch = [record for _, record in zip(range(batch_size), reader)]
+            if len(batch) == 0: break
+            results = pool.map(parse_record, [record.url for record in batch], [record.text for record in batch], chunksize=16)
+            for record, result in zip(batch, results):
+                if result is not None:
+                    yield (record.url, *result)
+
+
+def reindex(directory, processes=None):
+    """Parses every archived page again, and writes pages, images and tokens like a crawl would"""
+    # imported here, so parser processes don't connect to the database
+    from webscraper.pipelines import ParserPipeline, DedupePipeline, MongoPipeline
+    parser, dedupe, mongo = ParserPipeline(), DedupePipeline(), MongoPipeline()
+    dedupe.open_spider(None)
+    mongo.open_spider(None)
+    for url, urls, parsed in reprocess(directory, processes):
+        item = parser.make_item({"url": url, "urls": urls, "backlinks": []}, parsed)
+        mongo.process_item(dedupe.process_item(item, None), None)
+    dedupe.close_spider(None)
+    mongo.close_spider(None)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Parse archived pages again and write them to the database")
+    parser.add_argument("directory", help="archive directory (ARCHIVE_DIR)")
+    parser.add_argument("--processes", type=int, default=None, help="parser processes (default: all cores)")
+    args = parser.parse_args()
+    reindex(args.directory, args.processes)
@@ -0,0 +1,138 @@
+"""Bloom filters for remembering which requests were seen, without keeping every fingerprint in memory"""
+import json
+import math
+import mmap
+import os
+
+
+class BloomFilter:
+    """Fixed size bloom filter. Bits are kept in a memory-mapped file if path is given, else in memory
+
+    :param capacity: how many items it holds before the false positive rate goes over error_rate
+    :param error_rate: chance of saying an item was added when it wasn't
+    """
+
+    def __init__(self, capacity: int, error_rate: float, path=None, count=0) -> None:
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.count = count
+        self.num_bits = math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2))
+        self.num_hashes = max(1, round(self.num_bits / capacity * math.log(2)))
+        size = (self.num_bits + 7) // 8
+        self.file = None
+        if path is None:
+            self.bits = bytearray(size)
+        else:
+            # new files are sparse, so they don't use disk until bits get set
+            self.file = open(path, "a+b")
+            if os.path.getsize(path) < size:
+                self.file.truncate(size)
+            self.bits = mmap.mmap(self.file.fileno(), size)
+
+    def indexes(self, h1: int, h2: int):
+        # double hashing, see Kirsch & Mitzenmacher "Less hashing, same performance"
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def contains(self, h1: int, h2: int) -> bool:
+        bits = self.bits
+        return all(bits[i >> 3] & (1 << (i & 7)) for i in self.indexes(h1, h2))
+
+    def add(self, h1: int, h2: int):
+        bits = self.bits
+        for i in self.indexes(h1, h2):
+            bits[i >> 3] |= 1 << (i & 7)
+        self.count += 1
+
+    def close(self):
+        if self.file is not None:
+            self.bits.flush()
+            self.bits.close()
+            self.file.close()
+
+
+class ScalableBloomFilter:
+    """Bloom filter that grows as needed (see Almeida et al. "Scalable Bloom Filters")
+
+    When the newest filter is full, a new one with `growth` times the capacity and a `tightening` times lower
+    error rate is added, so the total false positive rate stays under error_rate however many items are added.
+    If path (a directory) is given, every filter is a memory-mapped file in it, so opening it again is instant.
+    The item counts are saved every `save_every` adds, so a crawl that gets killed doesn't lose track of how full
+    the filters are (it can only be off by the adds since the last save)
+
+    Items are hex strings of hashes (like Scrapy's request fingerprints), so we don't hash them again
+    """
+
+    def __init__(self, initial_capacity=1000000, error_rate=0.001, path=None, growth=2, tightening=0.5, save_every=10000) -> None:
+        self.path = path
+        self.growth = growth
+        self.tightening = tightening
+        self.save_every = save_every
+        self.unsaved = 0
+        self.filters = []
+        slices = []
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+            if os.path.exists(self.meta_path()):
+                with open(self.meta_path()) as f:
+                    meta = json.load(f)
+                initial_capacity, error_rate = meta["initial_capacity"], meta["error_rate"]
+                slices = meta["slices"]
+        self.initial_capacity = initial_capacity
+        self.error_rate = error_rate
+        for i, count in enumerate(slices):
+            self.filters.append(self.make_filter(i, count))
+        if len(self.filters) == 0:
+            self.add_filter()
+
+    def meta_path(self):
+        return os.path.join(self.path, "meta.json")
+
+    def make_filter(self, i: int, count=0) -> BloomFilter:
+        # error rates of all filters add up to error_rate, since (1 - tightening) + (1 - tightening) * tightening + ... = 1
+        return BloomFilter(
+            self.initial_capacity * self.growth ** i,
+            self.error_rate * (1 - self.tightening) * self.tightening ** i,
+            os.path.join(self.path, f"{i}.bloom") if self.path is not None else None,
+            count
+        )
+
+    def add_filter(self):
+        self.filters.append(self.make_filter(len(self.filters)))
+        self.save()
+
+    def __len__(self):
+        return sum(bloom.count for bloom in self.filters)
+
+    def __contains__(self, fingerprint: str) -> bool:
+        h1 = int(fingerprint[:16], 16)
+        h2 = int(fingerprint[16:32], 16) | 1
+        return any(bloom.contains(h1, h2) for bloom in reversed(self.filters))
+
+    def add(self, fingerprint: str) -> bool:
+        """Adds fingerprint. Returns True if it was (probably) already added"""
+        h1 = int(fingerprint[:16], 16)
+        h2 = int(fingerprint[16:32], 16) | 1
+        for bloom in reversed(self.filters):
+            if bloom.contains(h1, h2): return True
+        if self.filters[-1].count >= self.filters[-1].capacity:
+            self.add_filter()
+        self.filters[-1].add(h1, h2)
+        self.unsaved += 1
+        if self.unsaved >= self.save_every: self.save()
+        return False
+
+    def save(self):
+        self.unsaved = 0
+        if self.path is None: return
+        with open(self.meta_path() + ".tmp", "w") as f:
+            json.dump({
+                "initial_capacity": self.initial_capacity,
+                "error_rate": self.error_rate,
+                "slices": [bloom.count for bloom in self.filters]
+            }, f)
+        os.replace(self.meta_path() + ".tmp", self.meta_path())
+
+    def close(self):
+        self.save()
+        for bloom in self.filters:
+            bloom.close()
@@ -1,12 +1,28 @@
 from web.database import PagesDatabase, ImageDatabase, PageTokensDatabase, ImageTokensDatabase
-from webscraper.settings import DB_BUFFER_SIZE, DB_UPLOAD_DELAY
+from webscraper.settings import DB_BUFFER_SIZE, DB_UPLOAD_DELAY, TOKENS_BUCKET_SIZE, DB_ASYNC_WRITES, DB_WRITE_QUEUE_SIZE
+from webscraper.settings import BACKLINKS_BUFFER_SIZE, BACKLINK_COUNT
 
 class BacklinksDatabase(PagesDatabase):
-    def push_to_db(self):
-        if len(self.buffer) == 0: return
-        try: self.collection.bulk_write(self.buffer, ordered=False)
-        except Exception as e: pass
-        self.buffer *= 0
+    """Collects backlinks of pages in memory as url -> set of backlinks, and writes them as one update per url.
+    The buffer size is counted in backlinks
+    """
+    def __init__(self, db_buffer_size=100, db_upload_delay=0, async_writes=False, write_queue_size=4, count_backlinks=False):
+        super().__init__(db_buffer_size, db_upload_delay, async_writes, write_queue_size, count_backlinks)
+        self.buffer = {}
+
+    def add_backlink(self, url, backlink):
+        with self.buffer_lock:
+            backlinks = self.buffer.setdefault(url, set())
+            if backlink not in backlinks:
+                backlinks.add(backlink)
+                self.buffer_size += 1
+        if self.should_push():
+            self.push_to_db()
+
+    def write(self, batch):
+        updates = [self.upsert_page(url, backlinks) for url, backlinks in batch.items()]
+        try: self.collection.bulk_write(updates, ordered=False)
+        except Exception as e: self.write_errors += 1
 
 
 class CrawlerDB():
@@ -15,11 +31,11 @@ class CrawlerDB():
     """
     __instance = None
 
-    pages_db = PagesDatabase(DB_BUFFER_SIZE, DB_UPLOAD_DELAY)
-    images_db = ImageDatabase(DB_BUFFER_SIZE, DB_UPLOAD_DELAY)
-    writes_db = BacklinksDatabase(DB_BUFFER_SIZE, DB_UPLOAD_DELAY)
-    page_tokens_db = PageTokensDatabase(DB_BUFFER_SIZE, DB_UPLOAD_DELAY)
-    image_tokens_db = ImageTokensDatabase(DB_BUFFER_SIZE, DB_UPLOAD_DELAY)
+    pages_db = PagesDatabase(DB_BUFFER_SIZE, DB_UPLOAD_DELAY, DB_ASYNC_WRITES, DB_WRITE_QUEUE_SIZE, BACKLINK_COUNT)
+    images_db = ImageDatabase(DB_BUFFER_SIZE, DB_UPLOAD_DELAY, DB_ASYNC_WRITES, DB_WRITE_QUEUE_SIZE)
+    writes_db = BacklinksDatabase(BACKLINKS_BUFFER_SIZE, DB_UPLOAD_DELAY, DB_ASYNC_WRITES, DB_WRITE_QUEUE_SIZE, BACKLINK_COUNT)
+    page_tokens_db = PageTokensDatabase(DB_BUFFER_SIZE, DB_UPLOAD_DELAY, TOKENS_BUCKET_SIZE, DB_ASYNC_WRITES, DB_WRITE_QUEUE_SIZE)
+    image_tokens_db = ImageTokensDatabase(DB_BUFFER_SIZE, DB_UPLOAD_DELAY, TOKENS_BUCKET_SIZE, DB_ASYNC_WRITES, DB_WRITE_QUEUE_SIZE)
 
     def __new__(cls):
         if cls.__instance is None:
@@ -31,13 +47,14 @@ class CrawlerDB():
         """Closes all connections in an ORDERED manner"""
         # TODO: maybe there's a more elegant way to do this?
         if CrawlerDB.pages_db is not None:
-            CrawlerDB.pages_db.push_to_db()
-            CrawlerDB.images_db.push_to_db()
-            CrawlerDB.writes_db.push_to_db()
-            CrawlerDB.page_tokens_db.push_to_db()
-            CrawlerDB.image_tokens_db.push_to_db()
+            # wait for each one to be fully written (including background writes) before moving to the next
+            CrawlerDB.pages_db.wait_for_writes()
+            CrawlerDB.images_db.wait_for_writes()
+            CrawlerDB.writes_db.wait_for_writes()
+            CrawlerDB.page_tokens_db.wait_for_writes()
+            CrawlerDB.image_tokens_db.wait_for_writes()
             CrawlerDB.pages_db.close_connection()
             CrawlerDB.images_db.close_connection()
             CrawlerDB.writes_db.close_connection()
             CrawlerDB.page_tokens_db.close_connection()
-            CrawlerDB.image_tokens_db.close_connection()
\ No newline at end of file
+            CrawlerDB.image_tokens_db.close_connection()
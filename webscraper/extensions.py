@@ -0,0 +1,104 @@
+"""Scrapy extension that keeps crawl stats up to date while crawling, to see what a long crawl is waiting on
+
+Every CRAWL_STATS_INTERVAL secs it adds to the stats collector:
+- items/sec and responses/sec over the last interval
+- how busy parsing kept us (spider_parse, parse, tokenize and images secs per sec, from ParserPipeline)
+- for each database: buffer depth, queued batches, flushes, average batch size, flush latency, and write errors
+  (a database busy for close to 1 sec per sec, or with full queues, means Mongo is what's holding us up)
+- how many requests are downloading and waiting in the scheduler
+It logs a summary line, and dumps all the stats to CRAWL_STATS_FILE as JSON (also when the crawl ends)
+"""
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+from twisted.internet import task
+from webscraper.crawler_database import CrawlerDB
+import json
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+DATABASES = ["pages_db", "images_db", "writes_db", "page_tokens_db", "image_tokens_db"]
+
+
+class CrawlStats:
+    def __init__(self, stats, interval=60, path=None) -> None:
+        self.stats = stats
+        self.interval = interval
+        self.path = path
+        self.task = None
+        self.last = {}
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        interval = crawler.settings.getfloat("CRAWL_STATS_INTERVAL", 60)
+        if interval <= 0: raise NotConfigured
+        extension = cls(crawler.stats, interval, crawler.settings.get("CRAWL_STATS_FILE", None))
+        extension.crawler = crawler
+        crawler.signals.connect(extension.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(extension.spider_closed, signal=signals.spider_closed)
+        return extension
+
+    def spider_opened(self, spider):
+        self.start = self.last_time = time.time()
+        self.task = task.LoopingCall(self.update, spider)
+        self.task.start(self.interval, now=False)
+
+    def spider_closed(self, spider, reason):
+        if self.task is not None and self.task.running:
+            self.task.stop()
+        self.update(spider)
+
+    def rate(self, key, value, elapsed):
+        """Change of a counter per sec since the last update"""
+        change = value - self.last.get(key, 0)
+        self.last[key] = value
+        return change / elapsed if elapsed > 0 else 0
+
+    def update(self, spider):
+        now = time.time()
+        elapsed = now - self.last_time
+        self.last_time = now
+        stats = self.stats
+
+        items_per_sec = self.rate("items", stats.get_value("item_scraped_count", 0), elapsed)
+        stats.set_value("crawl/items_per_sec", items_per_sec)
+        stats.set_value("crawl/responses_per_sec", self.rate("responses", stats.get_value("response_received_count", 0), elapsed))
+        parser_busy = 0
+        for stage in ["spider_parse", "parse", "tokenize", "images"]:
+            busy = self.rate(stage, stats.get_value(f"parser/{stage}_seconds", 0), elapsed)
+            stats.set_value(f"parser/{stage}_busy", busy)
+            parser_busy += busy
+
+        db_busy = {}
+        for name in DATABASES:
+            if (db := getattr(CrawlerDB, name, None)) is None: continue
+            write_stats = db.get_write_stats()
+            for key, value in write_stats.items():
+                stats.set_value(f"db/{name}/{key}", value)
+            flushes = write_stats["flushes"]
+            stats.set_value(f"db/{name}/avg_batch_size", write_stats["flushed_items"] / flushes if flushes > 0 else 0)
+            stats.set_value(f"db/{name}/avg_flush_seconds", write_stats["flush_seconds"] / flushes if flushes > 0 else 0)
+            db_busy[name] = self.rate(f"{name}_flush", write_stats["flush_seconds"], elapsed)
+            stats.set_value(f"db/{name}/busy", db_busy[name])
+
+        try:
+            engine = self.crawler.engine
+            stats.set_value("crawl/downloading", len(engine.downloader.active))
+            stats.set_value("crawl/scheduled", len(engine.slot.scheduler))
+        except Exception as e: pass
+
+        busiest_db = max(db_busy, key=db_busy.get, default=None)
+        logger.info(
+            "%.1f items/sec, parser busy %.2f, busiest db %s (busy %.2f), %s downloading, %s scheduled",
+            items_per_sec, parser_busy, busiest_db, db_busy.get(busiest_db, 0),
+            stats.get_value("crawl/downloading", "?"), stats.get_value("crawl/scheduled", "?"),
+            extra={"spider": spider}
+        )
+        if self.path: self.dump()
+
+    def dump(self):
+        with open(self.path + ".tmp", "w") as f:
+            json.dump({**self.stats.get_stats(), "crawl/elapsed_seconds": time.time() - self.start}, f, indent=4, default=str)
+        os.replace(self.path + ".tmp", self.path)
@@ -0,0 +1,205 @@
+"""Crawl frontier that fetches the most important pages first, instead of breadth-first
+
+Waiting requests are scored by:
+- in-links: how many times their url was linked (every request DupeFilter sees is a link to its url)
+- domain quality: links to the url's domain from other domains, plus boosts from FRONTIER_DOMAIN_QUALITY
+- depth: pages further from the start urls score lower
+and the best score is popped first (FIFO between equal scores, so ties still go breadth-first). Like
+DownloaderAwarePriorityQueue, which this extends, domains with the fewest active downloads go first.
+
+Link counts are kept in a count-min sketch, so memory stays the same however many urls there are. When a url that's
+still waiting gets enough new links to move up, its request is pushed again with the better priority (the disk queues
+can't move or remove requests). The first copy popped is the best one, the others are skipped when they come up.
+With JOBDIR, the sketch and the reprioritized urls are kept in JOBDIR/frontier, so a resumed crawl keeps its scores
+"""
+from scrapy.pqueues import DownloaderAwarePriorityQueue
+from scrapy.utils.job import job_dir
+from w3lib.url import canonicalize_url
+from webscraper.bloom import ScalableBloomFilter
+from webscraper.settings import FRONTIER_LINK_WEIGHT, FRONTIER_DOMAIN_WEIGHT, FRONTIER_DEPTH_WEIGHT, FRONTIER_DOMAIN_QUALITY
+from webscraper.settings import FRONTIER_SKETCH_WIDTH, FRONTIER_SKETCH_DEPTH, DUPEFILTER_BLOOM_CAPACITY, DUPEFILTER_BLOOM_ERROR_RATE
+from functools import lru_cache
+from urllib.parse import urlparse
+import hashlib
+import json
+import math
+import numpy as np
+import os
+
+
+def fingerprint(key: str) -> str:
+    """Hex hash of a key, in the format ScalableBloomFilter takes"""
+    return hashlib.blake2b(key.encode("utf-8"), digest_size=16).hexdigest()
+
+
+@lru_cache(maxsize=100000)
+def domain_quality(host: str) -> float:
+    """Boost of the host's domain in FRONTIER_DOMAIN_QUALITY (subdomains get their parent domain's boost)"""
+    parts = host.split(".")
+    for i in range(len(parts)):
+        if (domain := ".".join(parts[i:])) in FRONTIER_DOMAIN_QUALITY:
+            return FRONTIER_DOMAIN_QUALITY[domain]
+    return 0
+
+
+class CountMinSketch:
+    """Approximate counts of keys in fixed memory (see Cormode & Muthukrishnan "An Improved Data Stream Summary:
+    The Count-Min Sketch"). Counts can be too high (when keys share counters), never too low.
+    Counters are kept in a memory-mapped file if path is given
+    """
+
+    def __init__(self, width=1 << 21, depth=4, path=None) -> None:
+        self.width = width
+        self.depth = depth
+        self.rows = np.arange(depth)
+        if path is None:
+            self.table = np.zeros((depth, width), dtype=np.uint32)
+        else:
+            # new files are sparse, like the bloom filters
+            self.table = np.memmap(path, dtype=np.uint32, mode="r+" if os.path.exists(path) else "w+", shape=(depth, width))
+
+    def columns(self, key: str) -> list:
+        digest = fingerprint(key)
+        h1 = int(digest[:16], 16)
+        h2 = int(digest[16:], 16) | 1
+        return [(h1 + i * h2) % self.width for i in range(self.depth)]
+
+    def add(self, key: str) -> int:
+        """Counts key once more. Returns its new count"""
+        columns = self.columns(key)
+        counts = self.table[self.rows, columns]
+        count = counts.min() + 1
+        # conservative update: only counters below the new count go up, so other keys' counts grow less
+        self.table[self.rows, columns] = np.maximum(counts, count)
+        return int(count)
+
+    def get(self, key: str) -> int:
+        return int(self.table[self.rows, self.columns(key)].min())
+
+    def close(self):
+        if isinstance(self.table, np.memmap):
+            self.table.flush()
+
+
+class Frontier:
+    """Link counts and reprioritization state, shared by DupeFilter (which counts links as it sees requests)
+    and FrontierPriorityQueue (which scores requests with them). Static variables, like CrawlerDB.
+    It's opened by the priority queue, so nothing is counted if another priority queue is used
+    """
+    path = None
+    links = None
+    # urls that were popped, to know if a url is still waiting
+    fetched = None
+    # urls pushed more than once -> [copies still in the queues, whether one was popped already]
+    repushed = {}
+    # queue that reprioritized requests go to (the disk queue if there's a JOBDIR, since that's where requests go)
+    queue = None
+
+    @classmethod
+    def open(cls, path=None):
+        if cls.links is not None: return
+        if path: os.makedirs(path, exist_ok=True)
+        cls.path = path
+        cls.links = CountMinSketch(FRONTIER_SKETCH_WIDTH, FRONTIER_SKETCH_DEPTH, os.path.join(path, "links.sketch") if path else None)
+        cls.fetched = ScalableBloomFilter(
+            DUPEFILTER_BLOOM_CAPACITY, DUPEFILTER_BLOOM_ERROR_RATE, os.path.join(path, "fetched") if path else None
+        )
+        cls.repushed = {}
+        if path and os.path.exists(cls.repushed_path()):
+            with open(cls.repushed_path()) as f:
+                cls.repushed = json.load(f)
+
+    @classmethod
+    def repushed_path(cls):
+        return os.path.join(cls.path, "repushed.json")
+
+    @classmethod
+    def close(cls):
+        if cls.links is None: return
+        cls.links.close()
+        cls.fetched.close()
+        if cls.path:
+            with open(cls.repushed_path() + ".tmp", "w") as f:
+                json.dump(cls.repushed, f)
+            os.replace(cls.repushed_path() + ".tmp", cls.repushed_path())
+        cls.links = cls.fetched = cls.queue = None
+
+    @classmethod
+    def score(cls, request, url=None, links=None) -> float:
+        url = url or canonicalize_url(request.url)
+        host = urlparse(request.url).hostname or ""
+        if cls.links is None: links = domain_links = 0
+        else:
+            if links is None: links = cls.links.get(url)
+            domain_links = cls.links.get("domain:" + host)
+        # logs, so the thousandth link counts a lot less than the second one
+        return (
+            FRONTIER_LINK_WEIGHT * math.log2(1 + links)
+            + FRONTIER_DOMAIN_WEIGHT * math.log2(1 + domain_links) + domain_quality(host)
+            - FRONTIER_DEPTH_WEIGHT * request.meta.get("depth", 0)
+            + request.priority
+        )
+
+    @classmethod
+    def priority(cls, request, url=None, links=None) -> int:
+        """Priority of a request's internal queue in ScrapyPriorityQueue (lower goes first)"""
+        return -round(cls.score(request, url, links))
+
+    @classmethod
+    def add_link(cls, request, seen: bool):
+        """Counts a link to the request's url (and to its domain, if it's linked from another domain).
+        If the url was seen before, is still waiting, and moves up with this link, the request is pushed again
+        """
+        if cls.links is None: return
+        url = canonicalize_url(request.url)
+        if (backlink := request.meta.get("backlink", None)) and urlparse(backlink).hostname != urlparse(request.url).hostname:
+            cls.links.add("domain:" + (urlparse(request.url).hostname or ""))
+        links = cls.links.add(url)
+        if not seen or cls.queue is None: return
+        if cls.priority(request, url, links) >= cls.priority(request, url, links - 1): return
+        if (entry := cls.repushed.get(url, None)) is None:
+            # a false positive just means the url doesn't move up
+            if fingerprint(url) in cls.fetched: return
+            entry = cls.repushed[url] = [1, False]
+        elif entry[1]: return
+        entry[0] += 1
+        cls.queue.push(request)
+        cls.queue.stats.inc_value("frontier/repushed")
+
+    @classmethod
+    def take(cls, request) -> bool:
+        """Called for every popped request. Returns False if it's an old copy of a reprioritized url that was already popped"""
+        if cls.links is None: return True
+        url = canonicalize_url(request.url)
+        cls.fetched.add(fingerprint(url))
+        if (entry := cls.repushed.get(url, None)) is None: return True
+        entry[0] -= 1
+        first = not entry[1]
+        entry[1] = True
+        if entry[0] <= 0: del cls.repushed[url]
+        return first
+
+
+class FrontierPriorityQueue(DownloaderAwarePriorityQueue):
+    """Scheduler priority queue that pops the best scored requests first (see Frontier).
+    Set SCHEDULER_PRIORITY_QUEUE to use it, requests are counted by DupeFilter
+    """
+
+    def __init__(self, crawler, downstream_queue_cls, key, slot_startprios=None, **kwargs):
+        super().__init__(crawler, downstream_queue_cls, key, slot_startprios, **kwargs)
+        self.stats = crawler.stats
+        path = job_dir(crawler.settings)
+        Frontier.open(os.path.join(path, "frontier") if path else None)
+        if key or Frontier.queue is None: Frontier.queue = self
+
+    def pqfactory(self, slot, startprios=()):
+        queue = super().pqfactory(slot, startprios)
+        # ScrapyPriorityQueue picks the internal queue of a request with this (instead of -request.priority)
+        queue.priority = Frontier.priority
+        return queue
+
+    def pop(self):
+        while (request := super().pop()) is not None:
+            if Frontier.take(request): return request
+            self.stats.inc_value("frontier/skipped")
+        return None
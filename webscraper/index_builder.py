@@ -0,0 +1,170 @@
+"""Offline index building: the crawler spills postings to disk, and the token collections are built from them afterwards
+
+With INDEX_MODE = "offline", MongoPipeline gives token histograms to a SpillWriter instead of the token databases.
+It keeps (token, url, count) postings in memory, and every `run_size` postings writes them out as sorted runs,
+split into partitions by token hash. Run files are gzipped lines of `token<TAB>url<TAB>count`, named
+<partition>-<time>-<pid>-<run>.gz, so crawls (also ones running at the same time) only ever add files.
+
+Building merges the runs of each partition (in parallel, one process per partition at a time) into complete,
+sorted posting lists, and bulk loads them as buckets with plain ordered inserts. A partition has every posting of
+its tokens, so there is nothing to read back from Mongo. The runs are the whole corpus: keep them, and rebuild after
+every crawl (clear them before changing the number of partitions). A url that was crawled again keeps the counts
+of its newest run (tokens the page doesn't have anymore stay until the runs are cleared). The collection is built in a temporary collection, which then replaces it.
+
+Usage (from the project root): python -m webscraper.index_builder [--images] [--processes 4]
+"""
+from concurrent.futures import ProcessPoolExecutor
+from web.database import PageTokensDatabase, ImageTokensDatabase
+from webscraper.settings import INDEX_SPILL_DIR, TOKENS_BUCKET_SIZE
+import argparse
+import gzip
+import heapq
+import multiprocessing
+import os
+import time
+import zlib
+
+
+def partition_of(token: str, partitions: int) -> int:
+    # crc32 rather than hash(), which is different in every process
+    return zlib.crc32(token.encode("utf-8")) % partitions
+
+
+class SpillWriter:
+    """Takes token histograms like the token databases do (insert/insert_many), and writes them as sorted runs"""
+
+    def __init__(self, directory, partitions=16, run_size=1000000) -> None:
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.partitions = partitions
+        self.run_size = run_size
+        self.buffer = []
+        self.name = f"{int(time.time())}-{os.getpid()}"
+        self.runs = 0
+        self.count = 0
+
+    def insert(self, item):
+        url = item["url"]
+        self.buffer.extend((token, url, count) for token, count in item["tokens"].items())
+        if len(self.buffer) >= self.run_size:
+            self.write_run()
+
+    def insert_many(self, items):
+        for item in items:
+            self.insert(item)
+
+    def write_run(self):
+        if len(self.buffer) == 0: return
+        self.buffer.sort()
+        # sorting first keeps every partition's part sorted too
+        parts = [[] for _ in range(self.partitions)]
+        for posting in self.buffer:
+            parts[partition_of(posting[0], self.partitions)].append(posting)
+        for partition, postings in enumerate(parts):
+            if len(postings) == 0: continue
+            path = os.path.join(self.directory, f"{partition:03d}-{self.name}-{self.runs:06d}.gz")
+            # compresslevel 1, it's mostly about disk space and the runs are written a lot more than read
+            with gzip.open(path + ".tmp", "wt", encoding="utf-8", compresslevel=1) as f:
+                f.writelines(f"{token}\t{url}\t{count}\n" for token, url, count in postings)
+            os.replace(path + ".tmp", path)
+        self.count += len(self.buffer)
+        self.runs += 1
+        self.buffer = []
+
+    def close(self):
+        self.write_run()
+
+
+def list_partitions(directory):
+    return sorted({int(name.split("-", 1)[0]) for name in os.listdir(directory) if name.endswith(".gz")})
+
+def run_order(path):
+    """(time, pid, run) of a run file, so runs sort oldest first"""
+    return tuple(int(part) for part in os.path.basename(path)[:-len(".gz")].split("-")[1:])
+
+def list_runs(directory, partition):
+    """Returns paths of the runs of a partition, oldest first"""
+    prefix = f"{partition:03d}-"
+    return sorted((
+        os.path.join(directory, name) for name in os.listdir(directory)
+        if name.startswith(prefix) and name.endswith(".gz")
+    ), key=run_order)
+
+
+def read_run(path):
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        for line in f:
+            token, url, count = line.rstrip("\n").rsplit("\t", 2)
+            yield token, url, int(count)
+
+def read_numbered_run(path, number):
+    """Postings of a run as (token, url, run number, count), so merged postings of a url come oldest run first"""
+    for token, url, count in read_run(path):
+        yield token, url, number, count
+
+
+def merge_partition(directory, partition, images, collection_name, bucket_size=1000, batch_size=1000):
+    """Merges the runs of a partition and inserts their buckets. Returns (tokens, postings) written"""
+    tokens_db = ImageTokensDatabase() if images else PageTokensDatabase()
+    collection = tokens_db.database[collection_name]
+    buckets = []
+    tokens = postings_count = 0
+    def write_token(token, urls):
+        nonlocal tokens, postings_count
+        postings = [{"url": url, "count": count} for url, count in urls.items()]
+        buckets.extend(PageTokensDatabase.make_buckets(token, postings, bucket_size))
+        tokens += 1
+        postings_count += len(postings)
+        if len(buckets) >= batch_size:
+            collection.insert_many(buckets, ordered=True)
+            buckets.clear()
+
+    # runs are sorted by token, so each token's postings come one after another
+    token, urls = None, {}
+    runs = [read_numbered_run(path, number) for number, path in enumerate(list_runs(directory, partition))]
+    for posting_token, url, number, count in heapq.merge(*runs):
+        if posting_token != token:
+            if token is not None: write_token(token, urls)
+            token, urls = posting_token, {}
+        # a url shows up more than once if it was crawled again. Its newest counts replace the old ones
+        # (adding them up would count the page once for every crawl)
+        urls[url] = count
+    if token is not None: write_token(token, urls)
+    if len(buckets) > 0: collection.insert_many(buckets, ordered=True)
+    tokens_db.close_connection()
+    return tokens, postings_count
+
+
+def build(directory, images=False, processes=None, bucket_size=1000):
+    tokens_db = ImageTokensDatabase() if images else PageTokensDatabase()
+    source = tokens_db.collection
+    target = tokens_db.database[source.name + "_building"]
+    target.drop()
+    # with the indexes already there, the collection is usable as soon as it's swapped in
+    PageTokensDatabase.create_indexes(target)
+
+    total_tokens = total_postings = 0
+    with ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context("spawn")) as pool:
+        jobs = [
+            pool.submit(merge_partition, directory, partition, images, target.name, bucket_size)
+            for partition in list_partitions(directory)
+        ]
+        for job in jobs:
+            tokens, postings = job.result()
+            total_tokens += tokens
+            total_postings += postings
+
+    target.rename(source.name, dropTarget=True)
+    tokens_db.bump_generation()
+    print ("- Built", total_tokens, "tokens and", total_postings, "postings into", source.name)
+    tokens_db.close_connection()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build a token collection from the postings spilled by the crawler")
+    parser.add_argument("--images", action="store_true", help="build image tokens instead of page tokens")
+    parser.add_argument("--dir", default=INDEX_SPILL_DIR, help="spill directory (INDEX_SPILL_DIR)")
+    parser.add_argument("--processes", type=int, default=None, help="merge processes (default: all cores)")
+    args = parser.parse_args()
+    directory = os.path.join(args.dir, "image_tokens" if args.images else "page_tokens")
+    build(directory, args.images, args.processes, TOKENS_BUCKET_SIZE)
@@ -10,15 +10,26 @@ class Page(Item):
     url = Field()
     urls = Field()
     backlinks = Field()
+    # raw html, only kept if it's parsed again in another process
     text = Field()
+    # lxml tree of the page, parsed once in the spider
+    doc = Field()
+    # secs the spider spent parsing the html
+    parse_time = Field()
 
 class ParsedPage(Page):
     _id = Field()
     backlinks = Field()
     title = Field()
     description = Field()
+    # shortened description shown in search results
+    snippet = Field()
+    # histogram of token -> count
     tokens = Field()
     images = Field()
+    # hex SimHash of tokens, and url of the page this is a near duplicate of (if it is one)
+    simhash = Field()
+    canonical = Field()
     time = Field()
 
     def __init__(self, *args, **kwargs):
@@ -30,6 +41,7 @@ class Image(Item):
     _id = Field()
     url = Field()
     alt = Field()
+    # histogram of token -> count
     tokens = Field()
     page_url = Field()
     time = Field()
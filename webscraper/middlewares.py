@@ -8,30 +8,55 @@ from itemadapter import ItemAdapter, is_item
 from scrapy import signals
 from webscraper.crawler_database import CrawlerDB
 from scrapy.dupefilters import RFPDupeFilter
+from scrapy.utils.job import job_dir
+from webscraper.bloom import ScalableBloomFilter
+from webscraper.frontier import Frontier
 from webscraper.scrape import format_url, remove_fragments
-from pymongo.operations import UpdateOne
+import os
 
 
 class DupeFilter(RFPDupeFilter):
-    def __init__(self, path, debug):
-        super().__init__(path=path, debug=debug)
+    """Request dupe filter that also records backlinks of duplicate requests, and counts links for the frontier (see frontier.py)
+
+    With DUPEFILTER_BLOOM, seen fingerprints go in a scalable bloom filter instead of a set (and the requests.seen file).
+    With JOBDIR, the bloom filter is memory-mapped in JOBDIR/requests.bloom, so resuming a crawl doesn't have to load anything
+    """
+    def __init__(self, path=None, debug=False, bloom=False, bloom_capacity=1000000, bloom_error_rate=0.001):
+        # don't let Scrapy load requests.seen if we use the bloom filter
+        super().__init__(path=None if bloom else path, debug=debug)
         self.write_db = CrawlerDB.writes_db
+        self.bloom = None
+        if bloom:
+            self.bloom = ScalableBloomFilter(
+                initial_capacity=bloom_capacity,
+                error_rate=bloom_error_rate,
+                path=os.path.join(path, "requests.bloom") if path else None
+            )
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(
+            job_dir(settings),
+            settings.getbool("DUPEFILTER_DEBUG"),
+            settings.getbool("DUPEFILTER_BLOOM"),
+            settings.getint("DUPEFILTER_BLOOM_CAPACITY", 1000000),
+            settings.getfloat("DUPEFILTER_BLOOM_ERROR_RATE", 0.001)
+        )
 
     def request_seen(self, request):
-        seen =  super().request_seen(request)
+        if self.bloom is not None: seen = self.bloom.add(self.request_fingerprint(request))
+        else: seen = super().request_seen(request)
+        # every request is a link to its url, the frontier (see frontier.py) crawls the most linked urls first
+        Frontier.add_link(request, seen)
         # This is one way we can catch duplicates, as Scrapy filters duplicates automatically here.
         # If we see we have encountered the same url/fingerprint, update backlinks
         if seen and request.meta.get("backlink", None):
-            url = remove_fragments(format_url(request.url))
-            self.write_db.insert(
-                UpdateOne(
-                    {"_id": url, "url": url},
-                    {"$addToSet": {"backlinks": format_url(request.meta.get("backlink"))}},
-                    upsert=True
-                )
-            )
+            # backlinks are grouped by url in memory, and written as one update per url
+            self.write_db.add_backlink(remove_fragments(format_url(request.url)), format_url(request.meta.get("backlink")))
         return seen
 
     def close(self, reason):
+        if self.bloom is not None: self.bloom.close()
+        Frontier.close()
         CrawlerDB.close_connections()
         return super().close(reason)
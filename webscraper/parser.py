@@ -0,0 +1,103 @@
+"""HTML parsing and tokenizing for crawled pages
+
+Kept apart from the pipelines (and the database connections they open), so it can run in worker processes
+"""
+from web.analyzer import get_word_counts, SNIPPET_LENGTH
+from lxml import html
+import re
+import time
+
+SPACES_PATTERN = re.compile(" +")
+
+def format_text(text):
+    # get rid of all new lines, then delete redundant spaces
+    return SPACES_PATTERN.sub(" ", text.replace("\n", " ")).strip(" ")
+
+def text_lengths(doc):
+    """Returns dict of element -> length of its text_content(), for every element in doc, in one pass"""
+    lengths = {}
+    # children come after their parents in doc.iter(), so going backwards we always see children first
+    for el in reversed(list(doc.iter())):
+        # comments and processing instructions don't count, but the text after them does
+        if not isinstance(el.tag, str): continue
+        length = len(el.text or "")
+        for child in el:
+            if isinstance(child.tag, str): length += lengths[child]
+            length += len(child.tail or "")
+        lengths[el] = length
+    return lengths
+
+def make_snippet(description):
+    return description[0:SNIPPET_LENGTH] + "..." if len(description) > SNIPPET_LENGTH else description
+
+def parse_document(text):
+    """Returns the lxml tree of a page's html, or None if there's nothing to parse"""
+    try: return html.fromstring(text.replace("</", " </"))
+    except Exception: return None
+
+def parse_html(text):
+    """Parses a page's html (see parse_tree). Returns None if there's nothing to parse"""
+    start = time.perf_counter()
+    if (doc := parse_document(text)) is None: return None
+    parse_time = time.perf_counter() - start
+    parsed = parse_tree(doc)
+    parsed["timings"]["parse"] += parse_time
+    return parsed
+
+def parse_tree(doc):
+    """Parses a page's lxml tree. Returns dict with title, description, snippet (shortened description),
+    tokens (histogram of token -> count), images (list of dicts with url, alt and tokens of the text around the image)
+    and timings (secs spent on each stage: parse, tokenize, images)
+    NOTE: this changes the tree (removes scripts and styles)
+    """
+    start = time.perf_counter()
+    # get rid of all tags we don't want to accidentally parse
+    for bad in doc.cssselect("script, style"):
+        bad.getparent().remove(bad)
+    # get info from head tag and page words as tokens
+    if (tags := doc.cssselect("title")) is not None and len(tags) > 0:
+        title = format_text(tags[0].text_content())
+    else: title = ""
+    description = format_text(metas[0].attrib.get("content", "")) if len(metas := doc.cssselect("meta[name=description]")) > 0 else ""
+    # tokens are kept as a histogram (token -> count), rather than a list with every occurrence
+    tokenize_start = time.perf_counter()
+    page_tokens = get_word_counts(doc.text_content(), stem=True)
+    images_start = time.perf_counter()
+    # get images and get surrounding text
+    lengths = text_lengths(doc)
+    # the surrounding text of an image is the closest ancestor with enough text. Images often share them,
+    # so remember which ancestor we picked for each parent, and the tokens of each ancestor
+    contexts = {}
+    context_tokens = {doc: page_tokens}
+    images = []
+    for img in doc.cssselect("img"):
+        src = img.attrib.get("src", "")
+        alt = img.attrib.get("alt", "")
+        div = img.getparent()
+        if (context := contexts.get(div, None)) is None:
+            context = div
+            # Average word length is 5, so 50 words has string length of 250 + 50 spaces
+            while lengths[context] <= 300 and (parent := context.getparent()) is not None:
+                context = parent
+            contexts[div] = context
+        if (tokens := context_tokens.get(context, None)) is None:
+            tokens = context_tokens[context] = get_word_counts(context.text_content(), stem=True)
+        image_tokens = tokens.copy()
+        image_tokens.update(get_word_counts(alt, stem=True))
+        images.append({
+            "url": src,
+            "alt": alt,
+            "tokens": image_tokens
+        })
+    return {
+        "title": title,
+        "description": description,
+        "snippet": make_snippet(description),
+        "tokens": page_tokens,
+        "images": images,
+        "timings": {
+            "parse": tokenize_start - start,
+            "tokenize": images_start - tokenize_start,
+            "images": time.perf_counter() - images_start
+        }
+    }
@@ -6,120 +6,203 @@
 
 # useful for handling different item types with a single interface
 from itemadapter import ItemAdapter
+from scrapy.exceptions import DropItem
 from webscraper.crawler_database import CrawlerDB
 from webscraper.items import Image, ParsedPage
-from webscraper.settings import UPLOAD_TOKENS
+from webscraper.parser import parse_html, parse_tree
+from webscraper.settings import UPLOAD_TOKENS, PARSER_PROCESSES, SIMHASH_MAX_DISTANCE, SIMHASH_MIN_TOKENS
+from webscraper.settings import ARCHIVE_DIR, ARCHIVE_SEGMENT_SIZE
+from webscraper.settings import INDEX_MODE, INDEX_SPILL_DIR, INDEX_SPILL_PARTITIONS, INDEX_SPILL_RUN_SIZE
+from webscraper.archive import ArchiveWriter
+from webscraper.index_builder import SpillWriter
+from webscraper.simhash import SimHashIndex, simhash
+from scrapy.utils.job import job_dir
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import os
+from twisted.internet import defer, reactor
 import time
-from nltk import PorterStemmer
-from lxml import html
-import re
+
+
+def defer_future(future):
+    """Turns a concurrent.futures future into a deferred that fires in the reactor thread"""
+    d = defer.Deferred()
+    def done(future):
+        try: result = future.result()
+        except Exception as e: reactor.callFromThread(d.errback, e)
+        else: reactor.callFromThread(d.callback, result)
+    future.add_done_callback(done)
+    return d
+
+
+class ArchivePipeline:
+    """Saves the raw html of every page to the archive in ARCHIVE_DIR (see archive.py), if it's set"""
+    def open_spider(self, spider):
+        self.archive = ArchiveWriter(ARCHIVE_DIR, ARCHIVE_SEGMENT_SIZE) if ARCHIVE_DIR else None
+
+    def close_spider(self, spider):
+        if self.archive is not None:
+            self.archive.close()
+            print ("- Archived pages:", self.archive.count)
+
+    def process_item(self, item, spider):
+        if self.archive is None: return item
+        if item.get("text", None):
+            self.archive.write(item["url"], item["text"])
+        # the html was only kept for the archive, the parser uses the tree
+        if PARSER_PROCESSES == 0: item["text"] = None
+        return item
+
 
 class ParserPipeline:
-    # from nltk.corpus import stopwords
-    # stopwords.words("english")
-    STOP_WORDS = set(['', 'i', 'me', 'my', 'myself', 'we', 'our', 'ours', 'ourselves', 'you', "you're", "you've", "you'll", "you'd", 'your', 'yours', 'yourself', 'yourselves', 'he', 'him', 'his', 'himself', 'she', "she's", 'her', 'hers', 'herself', 'it', "it's", 'its', 'itself', 'they', 'them', 'their', 'theirs', 'themselves', 'what', 'which', 'who', 'whom', 'this', 'that', "that'll", 'these', 'those', 'am', 'is', 'are', 'was', 'were', 'be', 'been', 'being', 'have', 'has', 'had', 'having', 'do', 'does', 'did', 'doing', 'a', 'an', 'the', 'and', 'but', 'if', 'or', 'because', 'as', 'until', 'while', 'of', 'at', 'by', 'for', 'with', 'about', 'against', 'between', 'into', 'through', 'during', 'before', 'after', 'above', 'below', 'to', 'from', 'up', 'down', 'in', 'out', 'on', 'off', 'over', 'under', 'again', 'further', 'then', 'once', 'here', 'there', 'when', 'where', 'why', 'how', 'all', 'any', 'both', 'each', 'few', 'more', 'most', 'other', 'some', 'such', 'no', 'nor', 'not', 'only', 'own', 'same', 'so', 'than', 'too', 'very', 's', 't', 'can', 'will', 'just', 'don', "don't", 'should', "should've", 'now', 'd', 'll', 'm', 'o', 're', 've', 'y', 'ain', 'aren', "aren't", 'couldn', "couldn't", 'didn', "didn't", 'doesn', "doesn't", 'hadn', "hadn't", 'hasn', "hasn't", 'haven', "haven't", 'isn', "isn't", 'ma', 'mightn', "mightn't", 'mustn', "mustn't", 'needn', "needn't", 'shan', "shan't", 'shouldn', "shouldn't", 'wasn', "wasn't", 'weren', "weren't", 'won', "won't", 'wouldn', "wouldn't"])
-    stemmer = PorterStemmer()
-
-    def format_text(self, text):
-        # get rid of all new lines, then delete redundant spaces
-        return re.sub(" +", " ", re.sub("\n", " ", text)).strip(" ")
-
-    def get_words(self, text, stem=True):
-        # get rid of punctuation, replace newlines and tabs with whitespace, and then split by whitespace
-        words = re.split(" +", re.sub("([^\w\s])|(\n)|(\t)|(\r)", " ", text).strip(" "))
-        valid = []
-        for word in words:
-            if not word.isascii(): continue
-            stemmed = ParserPipeline.stemmer.stem(word, to_lowercase=True) if stem else word.lower()
-            if stemmed not in ParserPipeline.STOP_WORDS:
-                valid.append(stemmed)
-        return valid
+    """Parses pages into ParsedPage items. With PARSER_PROCESSES > 0, the parsing is done in a pool of worker processes,
+    so it can use more than one core and doesn't hold up the crawler.
+    Time spent on each stage of parsing (parse, tokenize, images) is added to the crawl stats, and the time the spider
+    spent parsing the html (without parser processes) as spider_parse
+    """
+    def __init__(self, stats=None):
+        self.stats = stats
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler.stats)
+
+    def open_spider(self, spider):
+        # spawn rather than fork, so workers don't inherit the reactor and database connections (they only import the parser)
+        if PARSER_PROCESSES > 0:
+            self.pool = ProcessPoolExecutor(PARSER_PROCESSES, mp_context=multiprocessing.get_context("spawn"))
+        else: self.pool = None
+
+    def close_spider(self, spider):
+        if self.pool is not None:
+            self.pool.shutdown()
 
     def process_item(self, item, spider):
-        doc = html.fromstring(item["text"].replace("</", " </"))
-        # get rid of all tags we don't want to accidentally parse
-        for bad in doc.cssselect("script, style"):
-            bad.getparent().remove(bad)
-        # get info from head tag and page words as tokens
-        if (tags := doc.cssselect("title")) is not None and len(tags) > 0:
-            title = self.format_text(tags[0].text_content())
-        else: title = ""
-        description = self.format_text(metas[0].attrib.get("content", "")) if len(metas := doc.cssselect("meta[name=description]")) > 0 else ""
-        page_tokens = self.get_words(doc.text_content(), stem=True)
-        # get images and get surrounding text
-        images = []
-        for img in doc.cssselect("img"):
-            src = img.attrib.get("src", "")
-            alt = img.attrib.get("alt", "")
-            div = img.getparent()
-            # To keep things performant, don't get the words in each iteration. Instead, check string length
-            # Average word length is 5, so 50 words has string length of 250 + 50 spaces
-            while len(div.text_content()) <= 300 and (parent := div.getparent()) is not None:
-                div = parent
-            image_tokens = self.get_words(div.text_content() + " " + alt, stem=True)
-            images.append(Image(
-                url = src,
-                alt = alt,
-                tokens = image_tokens,
-                page_url = item["url"]
-            ))
+        if self.pool is None:
+            # the page was already parsed once when getting its urls, so we reuse that tree
+            if item.get("doc", None) is None: raise DropItem(f"Nothing to parse in {item['url']}")
+            return self.make_item(item, parse_tree(item["doc"]))
+        if not item.get("text", None): raise DropItem(f"Nothing to parse in {item['url']}")
+        # Scrapy waits on the deferred, and keeps crawling in the meantime
+        d = defer_future(self.pool.submit(parse_html, item["text"]))
+        d.addCallback(lambda parsed: self.make_item(item, parsed))
+        return d
+
+    def make_item(self, item, parsed):
+        if parsed is None: raise DropItem(f"Nothing to parse in {item['url']}")
+        if self.stats is not None:
+            # pages parsed in the spider come with the time it took. It's kept apart from the parse stage,
+            # since that time was spent on the reactor and not in a parser process
+            if (parse_time := item.get("parse_time", None)) is not None:
+                self.stats.inc_value("parser/spider_parse_seconds", parse_time)
+            for stage, seconds in parsed["timings"].items():
+                self.stats.inc_value(f"parser/{stage}_seconds", seconds)
+            self.stats.inc_value("parser/pages")
         return ParsedPage(
             url = item["url"],
             urls = item["urls"],
             backlinks = item["backlinks"],
-            title = title,
-            description = description,
-            tokens = page_tokens,
-            images = images
+            title = parsed["title"],
+            description = parsed["description"],
+            snippet = parsed["snippet"],
+            tokens = parsed["tokens"],
+            images = [Image(
+                url = image["url"],
+                alt = image["alt"],
+                tokens = image["tokens"],
+                page_url = item["url"]
+            ) for image in parsed["images"]]
         )
 
+class DedupePipeline:
+    """Finds pages that are near duplicates (mirrors, print views, urls with tracking params) of a page we already
+    have, by the SimHash of their tokens. Their tokens aren't indexed, and the page records the url of the first
+    copy as its canonical url. With a JOBDIR, the fingerprints are saved there so a resumed crawl remembers them
+    """
+    def __init__(self, path=None):
+        self.path = path
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        path = job_dir(crawler.settings)
+        return cls(os.path.join(path, "simhash.txt") if path else None)
+
+    def open_spider(self, spider):
+        self.index = SimHashIndex(SIMHASH_MAX_DISTANCE, self.path)
+        self.duplicates = 0
+
+    def close_spider(self, spider):
+        self.index.save()
+        print ("- Near duplicate pages:", self.duplicates)
+
+    def process_item(self, item, spider):
+        # fingerprints of tiny pages are too alike to tell anything
+        if len(item["tokens"]) < SIMHASH_MIN_TOKENS: return item
+        fingerprint = simhash(item["tokens"])
+        # hex string, since Mongo ints are signed 64 bit
+        item["simhash"] = f"{fingerprint:016x}"
+        canonical = self.index.find(fingerprint)
+        if canonical is None:
+            self.index.add(fingerprint, item["url"])
+        elif canonical != item["url"]:
+            item["canonical"] = canonical
+            item["tokens"] = {}
+            for image in item["images"]:
+                image["tokens"] = {}
+            self.duplicates += 1
+        return item
+
 class MongoPipeline:
     def open_spider(self, spider):
         self.pages_db = CrawlerDB.pages_db
         self.images_db = CrawlerDB.images_db
         self.page_tokens_db = CrawlerDB.page_tokens_db
         self.image_tokens_db = CrawlerDB.image_tokens_db
+        # spill writers take histograms the same way the token databases do
+        if INDEX_MODE == "offline":
+            self.page_tokens_db = SpillWriter(os.path.join(INDEX_SPILL_DIR, "page_tokens"), INDEX_SPILL_PARTITIONS, INDEX_SPILL_RUN_SIZE)
+            self.image_tokens_db = SpillWriter(os.path.join(INDEX_SPILL_DIR, "image_tokens"), INDEX_SPILL_PARTITIONS, INDEX_SPILL_RUN_SIZE)
         self.start_time = time.time()
         self.count = 0
         with open("summary_stats.txt", "w"):
             pass
     
     def close_spider(self, spider):
+        if INDEX_MODE == "offline":
+            self.page_tokens_db.close()
+            self.image_tokens_db.close()
+            print ("- Spilled", self.page_tokens_db.count, "page and", self.image_tokens_db.count, "image postings to", INDEX_SPILL_DIR)
         CrawlerDB.close_connections()
         elapsed_time = time.time() - self.start_time
+        # sizes come from collection metadata instead of counting every doc. Live stats are in CRAWL_STATS_FILE (see extensions.py)
+        summary = [
+            f"Time took: {elapsed_time} secs",
+            f"Total scraped: {self.count}",
+            f"Pages collection size: {self.pages_db.get_estimated_count()} docs",
+            f"Images collection size: {self.images_db.get_estimated_count()} docs",
+            f"Page tokens collection size: {CrawlerDB.page_tokens_db.get_estimated_count()} docs",
+            f"Image tokens collection size: {CrawlerDB.image_tokens_db.get_estimated_count()} docs"
+        ]
         with open("summary_stats.txt", "a") as f:
-            f.write(f"\nTime took: {elapsed_time} secs\n")
-            f.write(f"Total scraped: {self.count}\n")
-            f.write(f"Pages collection size: {self.pages_db.get_count()} docs\n")
-            f.write(f"Images collection size: {self.images_db.get_count()} docs\n")
-            f.write(f"Page tokens collection size: {self.page_tokens_db.get_count()} docs\n")
-            f.write(f"Image tokens collection size: {self.image_tokens_db.get_count()} docs\n")
+            f.write("\n" + "\n".join(summary) + "\n")
         print("\n" + ("=" * 30))
-        print ("Time took:", elapsed_time)
-        print ("Total scraped:", self.count)
-        print ("Pages collection size:", self.pages_db.get_count(), "docs")
-        print ("Images collection size:", self.images_db.get_count(), "docs")
-        print ("Page tokens collection size:", self.page_tokens_db.get_count(), "docs")
-        print ("Image tokens collection size:", self.image_tokens_db.get_count(), "tokens")
+        for line in summary:
+            print (line)
         print ("=" * 30, "\n")
 
     def process_item(self, item, spider):
         item = dict(item)
         images = item.pop("images", [])
-        if UPLOAD_TOKENS:
-            page_tokens = item.pop("tokens", [])
-            page_tokens_docs = [{
-                "token": token,
-                "url": item["url"]
-            } for token in page_tokens]
-            self.page_tokens_db.insert_many(page_tokens_docs)
-            for image in images:
-                image_tokens = image.pop("tokens", [])
-                image_token_docs = [{
-                    "url": image["url"],
-                    "token": token
-                } for token in image_tokens]
-                self.image_tokens_db.insert_many(image_token_docs)
+        # near duplicates (see DedupePipeline) are kept, but only their canonical page is searchable
+        if UPLOAD_TOKENS and "canonical" not in item:
+            self.page_tokens_db.insert({
+                "url": item["url"],
+                "tokens": item.pop("tokens", {})
+            })
+            self.image_tokens_db.insert_many([{
+                "url": image["url"],
+                "tokens": image.pop("tokens", {})
+            } for image in images])
         self.images_db.insert_many(images)
         self.pages_db.insert(item)
         self.count += 1
\ No newline at end of file
@@ -1,10 +1,27 @@
 from urllib.parse import urlparse
 from webscraper.items import Page
+from webscraper.parser import parse_document
+from webscraper.settings import PARSER_PROCESSES, ARCHIVE_DIR
+import html
+import re
+import time
+
+# href of an <a> tag, in double quotes, single quotes or none
+HREF_PATTERN = re.compile(r"""<a\s[^>]*?\bhref\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s"'>]+))""", re.IGNORECASE)
 
 def get_content(response):
-    """Basic content parsing from response page (getting text and urls)"""
+    """Basic content parsing from response page (getting text and urls)
+    Without parser processes, the html is parsed once here, and the same tree is used for the urls and later by
+    ParserPipeline. With them, the html is parsed in a worker, so the urls are found without parsing it here.
+    The raw html is only kept if it has to be sent to parser processes or archived
+    """
     try: text = response.text
     except: text = ""
+    if PARSER_PROCESSES == 0:
+        start = time.perf_counter()
+        doc = parse_document(text)
+        parse_time = time.perf_counter() - start
+    else: doc = parse_time = None
 
     # get backlink
     backlink = response.meta.get("backlink", None)
@@ -12,24 +29,35 @@ def get_content(response):
 
     return Page(
         url = format_url(response.url),
-        text = text,
-        urls = get_urls(response),
-        backlinks = backlinks
+        text = text if PARSER_PROCESSES > 0 or ARCHIVE_DIR else None,
+        doc = doc,
+        urls = get_urls(response, doc) if doc is not None else get_urls(response, hrefs=find_hrefs(text)),
+        backlinks = backlinks,
+        parse_time = parse_time
     )
 
-def get_urls(response):
-    """Gets all urls from a response page (used by crawlers)"""
-    try: hrefs = response.css("a::attr(href)").getall()
+def find_hrefs(text):
+    """Finds the hrefs of links in html without parsing it (much faster than lxml, but links
+    inside comments or scripts are found too)"""
+    return [html.unescape(next(group for group in match.groups() if group is not None))
+            for match in HREF_PATTERN.finditer(text)]
+
+def get_urls(response, doc=None, hrefs=None):
+    """Gets all urls from a response page (used by crawlers). Uses doc (lxml tree of the page) or hrefs if given"""
+    try:
+        if hrefs is None: hrefs = doc.xpath("//a/@href") if doc is not None else response.css("a::attr(href)").getall()
     except: return []
     urls = []
+    seen = set()
     accepted_schemas = ["http", "https"]
     for href in hrefs:
-        if urlparse(href).scheme in accepted_schemas and href not in urls:
-            urls.append(format_url(href))
-        else:
-            href = format_url(response.urljoin(href))
-            if urlparse(href).scheme in accepted_schemas and href not in urls:
-                urls.append(href)
+        if urlparse(href).scheme not in accepted_schemas:
+            href = response.urljoin(href)
+            if urlparse(href).scheme not in accepted_schemas: continue
+        href = format_url(href)
+        if href not in seen:
+            seen.add(href)
+            urls.append(href)
     return urls
 
 def format_url(url):
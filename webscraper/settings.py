@@ -72,16 +72,32 @@ ROTATING_PROXY_BACKOFF_CAP = 1800
 
 # Enable or disable extensions
 # See https://docs.scrapy.org/en/latest/topics/extensions.html
-# EXTENSIONS = {
+EXTENSIONS = {
 #    'scrapy.extensions.telnet.TelnetConsole': None,
-# }
+   'webscraper.extensions.CrawlStats': 500,
+}
+# how often (secs) CrawlStats updates throughput, parser and database stats, and the file it dumps them to (JSON)
+CRAWL_STATS_INTERVAL = 60
+CRAWL_STATS_FILE = "crawl_stats.json"
 
 # Configure item pipelines
 # See https://docs.scrapy.org/en/latest/topics/item-pipeline.html
 ITEM_PIPELINES = {
+   'webscraper.pipelines.ArchivePipeline': 0,
    'webscraper.pipelines.ParserPipeline': 1,
-   'webscraper.pipelines.MongoPipeline': 2,
+   'webscraper.pipelines.DedupePipeline': 2,
+   'webscraper.pipelines.MongoPipeline': 3,
 }
+# directory to archive raw html of crawled pages in (see archive.py), so they can be indexed again without recrawling.
+# None to not archive. A new archive segment file is started every ARCHIVE_SEGMENT_SIZE bytes
+ARCHIVE_DIR = None
+ARCHIVE_SEGMENT_SIZE = 1 << 30
+# pages whose token SimHash differs in at most this many bits (of 64) from a page we have are near duplicates.
+# pages with fewer distinct tokens than SIMHASH_MIN_TOKENS aren't checked
+SIMHASH_MAX_DISTANCE = 3
+SIMHASH_MIN_TOKENS = 20
+# how many worker processes parse and tokenize pages. 0 to parse in the crawler process
+PARSER_PROCESSES = 0
 
 # Enable and configure the AutoThrottle extension (disabled by default)
 # See https://docs.scrapy.org/en/latest/topics/autothrottle.html
@@ -107,11 +123,23 @@ ITEM_PIPELINES = {
 # Additional settings for broad crawls
 # See (https://docs.scrapy.org/en/latest/topics/broad-crawls.html)
 
-SCHEDULER_PRIORITY_QUEUE = 'scrapy.pqueues.DownloaderAwarePriorityQueue'
+# crawl the most important pages first (see frontier.py): waiting requests are scored by how often their url was linked,
+# how many links their domain gets from other domains, and their depth
+SCHEDULER_PRIORITY_QUEUE = 'webscraper.frontier.FrontierPriorityQueue'
 REACTOR_THREADPOOL_MAXSIZE = 50
-
-# go in breadth-first-order rather than depth first
-DEPTH_PRIORITY = 1
+# how much each of them counts. Links are counted in log2, so twice the links adds FRONTIER_LINK_WEIGHT
+FRONTIER_LINK_WEIGHT = 1
+FRONTIER_DOMAIN_WEIGHT = 0.5
+FRONTIER_DEPTH_WEIGHT = 1
+# extra score for pages of some domains (and their subdomains), e.g. {"wikipedia.org": 3}
+FRONTIER_DOMAIN_QUALITY = {}
+# size of the link counts (count-min sketch): FRONTIER_SKETCH_DEPTH rows of FRONTIER_SKETCH_WIDTH 4 byte counters.
+# wider means fewer urls share counters, so counts are closer
+FRONTIER_SKETCH_WIDTH = 1 << 21
+FRONTIER_SKETCH_DEPTH = 4
+
+# the frontier already scores depth, pages with the same score go in breadth-first-order (FIFO queues)
+DEPTH_PRIORITY = 0
 SCHEDULER_DISK_QUEUE = 'scrapy.squeues.PickleFifoDiskQueue'
 SCHEDULER_MEMORY_QUEUE = 'scrapy.squeues.FifoMemoryQueue'
 
@@ -129,8 +157,36 @@ LOG_LEVEL = 'INFO'
 
 # Custom dupe filter
 DUPEFILTER_CLASS = 'webscraper.middlewares.DupeFilter'
+# remember seen requests in a bloom filter rather than a set, so memory stays small on big crawls
+# (with JOBDIR it's memory-mapped in the job directory, so resuming is instant)
+DUPEFILTER_BLOOM = True
+# how many requests the first bloom filter holds. It grows on its own if the crawl goes over
+DUPEFILTER_BLOOM_CAPACITY = 10000000
+# chance of a new request being mistaken for a duplicate (and skipped)
+DUPEFILTER_BLOOM_ERROR_RATE = 0.0001
 
 # remember, don't set this too high, because Mongo max doc size is 16 MB
+# (token databases count their buffer in postings, i.e. unique token and url pairs)
 DB_BUFFER_SIZE = 1000
+# send buffered items to the db if they've waited this long (secs), even if the buffer isn't full. 0 to disable
 DB_UPLOAD_DELAY = 0
-UPLOAD_TOKENS = True
\ No newline at end of file
+# write to the db from background threads, so the crawler doesn't stop while waiting for Mongo
+DB_ASYNC_WRITES = True
+# how many full buffers (per collection) can wait to be written before the crawler has to wait
+DB_WRITE_QUEUE_SIZE = 4
+# how many backlinks (of duplicate requests) to collect before writing them. They're grouped by url,
+# so a bigger buffer means fewer updates for pages that are linked a lot
+BACKLINKS_BUFFER_SIZE = 10000
+# keep a backlink_count field on pages (needs MongoDB 4.2+)
+BACKLINK_COUNT = False
+UPLOAD_TOKENS = True
+# "online": tokens are written to the token collections while crawling.
+# "offline": tokens are spilled to sorted run files in INDEX_SPILL_DIR, and the token collections are built from them
+# after the crawl with `python -m webscraper.index_builder` (see index_builder.py)
+INDEX_MODE = "online"
+INDEX_SPILL_DIR = "index_runs"
+INDEX_SPILL_PARTITIONS = 16
+# postings held in memory before they're written out as a run
+INDEX_SPILL_RUN_SIZE = 1000000
+# max urls kept in one token bucket doc
+TOKENS_BUCKET_SIZE = 1000
\ No newline at end of file
@@ -0,0 +1,75 @@
+"""SimHash fingerprints of token histograms, and an index to find near duplicate pages with them
+
+Pages with (almost) the same words get fingerprints that differ in only a few bits. The index splits fingerprints
+into max_distance + 1 bands: two fingerprints within max_distance bits of each other must have at least one band
+exactly the same, so we only compare fingerprints that share a band
+"""
+from functools import lru_cache
+from hashlib import blake2b
+import numpy as np
+import os
+
+BITS = 64
+
+
+@lru_cache(maxsize=200000)
+def token_hash(token: str) -> int:
+    return int.from_bytes(blake2b(token.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+def simhash(histogram: dict) -> int:
+    """Returns 64 bit SimHash of a token histogram (token -> count), tokens weighted by count"""
+    if len(histogram) == 0: return 0
+    hashes = np.array([token_hash(token) for token in histogram], dtype=">u8")
+    weights = np.fromiter(histogram.values(), dtype=np.float64, count=len(histogram))
+    # one row of 64 bits (most significant first) per token
+    bits = np.unpackbits(hashes.view(np.uint8).reshape(-1, 8), axis=1)
+    votes = weights @ (bits.astype(np.float64) * 2 - 1)
+    return int.from_bytes(np.packbits(votes > 0).tobytes(), "big")
+
+
+def distance(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+class SimHashIndex:
+    """Finds urls whose fingerprint is within max_distance bits of a fingerprint
+
+    :param path: file to load the index from and save it to (optional)
+    """
+
+    def __init__(self, max_distance=3, path=None) -> None:
+        self.max_distance = max_distance
+        self.bands = max_distance + 1
+        self.band_bits = -(-BITS // self.bands)
+        self.tables = [{} for _ in range(self.bands)]
+        self.path = path
+        if path is not None and os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    fingerprint, url = line.rstrip("\n").split("\t", 1)
+                    self.add(int(fingerprint, 16), url)
+
+    def band_keys(self, fingerprint: int):
+        mask = (1 << self.band_bits) - 1
+        return [(fingerprint >> (i * self.band_bits)) & mask for i in range(self.bands)]
+
+    def find(self, fingerprint: int):
+        """Returns url of a near duplicate, or None"""
+        for table, key in zip(self.tables, self.band_keys(fingerprint)):
+            for other, url in table.get(key, []):
+                if distance(fingerprint, other) <= self.max_distance: return url
+        return None
+
+    def add(self, fingerprint: int, url: str):
+        for table, key in zip(self.tables, self.band_keys(fingerprint)):
+            table.setdefault(key, []).append((fingerprint, url))
+
+    def save(self):
+        if self.path is None: return
+        # every fingerprint is in every table, so the first one has all of them
+        with open(self.path + ".tmp", "w") as f:
+            for entries in self.tables[0].values():
+                for fingerprint, url in entries:
+                    f.write(f"{fingerprint:016x}\t{url}\n")
+        os.replace(self.path + ".tmp", self.path)